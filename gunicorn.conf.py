@@ -0,0 +1,20 @@
+"""Gunicorn settings used by the Procfile"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+
+# One worker by default: games (GAME_STATE_BACKEND=memory), retry dedup and per-user
+# ordering are per process. Replies mostly wait on the LLM, so a worker serves
+# requests from a thread pool.
+workers = int(os.getenv("HARSHA_WORKERS", 1))
+worker_class = "gthread"
+threads = int(os.getenv("HARSHA_THREADS", 16))
+timeout = 30
+
+# Import once in the master; each worker builds its own HarshaMemoryAPI after the fork
+preload_app = True
+
+
+def post_worker_init(worker):
+    import harsha_complete_api
+    harsha_complete_api.get_harsha().warmup()
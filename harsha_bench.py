@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Load-replay benchmark for the /chat endpoint
+
+Replays JSONL traffic ({"user_id": ..., "message": ...} per line) at a target
+concurrency and reports latency percentiles and throughput. Without --url it
+runs the API in-process on the offline LLM stub and a scratch database, so it
+needs no Azure credentials and spends no tokens.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable
+
+SYNTHETIC_MESSAGES = [
+    "yo what's good", "play a game", "roast me", "hype me up", "quick math",
+    "remember pizza?", "what do you think about mondays", "lol", "tell me something wild",
+    "i'm bored", "what can you do", "that movie was fire"
+]
+
+def load_traffic(path: str) -> List[Dict]:
+    """Read requests from a JSONL file; `message` falls back to `body`, `user_id` to `request_id`"""
+    traffic = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            traffic.append({
+                "user_id": str(item.get("user_id") or item.get("request_id") or "bench"),
+                "message": item.get("message") or item.get("body") or item.get("title") or ""
+            })
+    return traffic
+
+def synthetic_traffic(count: int, users: int, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    return [
+        {"user_id": f"bench_{rng.randrange(users)}", "message": rng.choice(SYNTHETIC_MESSAGES)}
+        for _ in range(count)
+    ]
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def make_sender(url: str, dedup: bool = False, response_cache: bool = False) -> Callable[[Dict], int]:
+    """POST one payload to /chat and return the status code"""
+    if url:
+        import httpx
+        client = httpx.Client(base_url=url, timeout=30)
+        return lambda payload: client.post("/chat", json=payload).status_code
+    
+    # In-process: stub LLM and a throwaway database unless the caller set their own
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    os.environ.setdefault("HARSHA_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="harsha_bench_"), "bench.db"))
+    # Synthetic traffic repeats a few messages, which retry dedup and the response
+    # cache would answer without running the pipeline; keep them off unless asked for
+    os.environ.setdefault("DEDUP", "1" if dedup else "0")
+    os.environ.setdefault("RESPONSE_CACHE", "1" if response_cache else "0")
+    import harsha_complete_api
+    
+    local = threading.local()
+    
+    def send(payload: Dict) -> int:
+        if not hasattr(local, "client"):
+            local.client = harsha_complete_api.app.test_client()
+        return local.client.post("/chat", json=payload).status_code
+    
+    return send
+
+def run(traffic: List[Dict], send: Callable[[Dict], int], concurrency: int) -> Dict:
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    
+    def one(payload: Dict):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = send(payload) < 500
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, traffic))
+    wall = time.perf_counter() - started
+    
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0
+    }
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Replay chat traffic against /chat")
+    parser.add_argument("--traffic", help="JSONL file of requests (default: synthetic)")
+    parser.add_argument("--url", help="benchmark a running server instead of in-process")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="total requests (traffic is cycled)")
+    parser.add_argument("--users", type=int, default=50, help="distinct users in synthetic traffic")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--no-activate", action="store_true", help="skip activating each user first")
+    parser.add_argument("--dedup", action="store_true", help="in-process: keep webhook retry dedup on")
+    parser.add_argument("--response-cache", action="store_true", help="in-process: keep the response/routing cache on")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    
+    traffic = load_traffic(args.traffic) if args.traffic else synthetic_traffic(args.requests, args.users, args.seed)
+    if not traffic:
+        print("No traffic to replay")
+        return 1
+    traffic = [traffic[i % len(traffic)] for i in range(args.requests)]
+    
+    send = make_sender(args.url, dedup=args.dedup, response_cache=args.response_cache)
+    if not args.no_activate:
+        # Inactive users short-circuit before the AI path, so switch everyone on first
+        for user_id in sorted({item["user_id"] for item in traffic}):
+            send({"user_id": user_id, "message": "talk to alter"})
+    
+    report = run(traffic, send, args.concurrency)
+    
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"📊 {report['requests']} requests @ concurrency {report['concurrency']} in {report['wall_s']}s")
+        print(f"   throughput: {report['throughput_rps']} req/s, errors: {report['errors']}")
+        print(f"   latency ms: p50 {report['p50_ms']} | p95 {report['p95_ms']} | p99 {report['p99_ms']} | max {report['max_ms']}")
+    return 1 if report["errors"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
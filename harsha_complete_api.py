@@ -4,21 +4,2111 @@ Harsha's Complete Alter Ego API with Persistent Memory + Function Calling
 """
 
 import os
+import re
 import json
 import random
 import time
 import sqlite3
-from flask import Flask, request, jsonify
-from datetime import datetime, timedelta
+import sys
+import queue
+import asyncio
+import atexit
+import argparse
+import hashlib
+import itertools
+import shutil
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from types import SimpleNamespace
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+import httpx
+from flask import Blueprint, Flask, Response, request, jsonify, stream_with_context
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from openai import AzureOpenAI
-from typing import List, Dict, Any
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from werkzeug.local import LocalProxy
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # only needed for SERVER_MODE=asgi
+    WsgiToAsgi = None
+try:
+    import numpy as np
+except ImportError:  # only needed for semantic recall (VECTOR_INDEX)
+    np = None
+try:
+    import zstandard
+except ImportError:  # archive blocks fall back to zlib
+    zstandard = None
 
 load_dotenv()
 
-app = Flask(__name__)
+bp = Blueprint("harsha", __name__)
+
+DB_PATH = os.getenv("HARSHA_DB_PATH", "harsha_memory.db")
+
+# DATABASE SCHEMA
+def _add_ai_active_column(conn: sqlite3.Connection):
+    """Add ai_active to user_stats tables created before it existed"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(user_stats)")]
+    if "ai_active" not in columns:
+        conn.execute("ALTER TABLE user_stats ADD COLUMN ai_active BOOLEAN DEFAULT FALSE")
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """Whether this SQLite build ships the FTS5 extension"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def fts_enabled(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts'").fetchone() is not None
+
+def build_fts_index(conn: sqlite3.Connection) -> bool:
+    """Create the conversations full-text index and its sync triggers, then backfill it.
+
+    Returns False (and leaves search on LIKE) when FTS5 is not compiled in.
+    """
+    if not fts5_available(conn):
+        print("⚠️ SQLite has no FTS5, memory search stays on LIKE")
+        return False
+    
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            user_id, message, response,
+            content='conversations', content_rowid='id',
+            tokenize='porter unicode61'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts(rowid, user_id, message, response)
+            VALUES (new.id, new.user_id, new.message, new.response);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, user_id, message, response)
+            VALUES ('delete', old.id, old.user_id, old.message, old.response);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, user_id, message, response)
+            VALUES ('delete', old.id, old.user_id, old.message, old.response);
+            INSERT INTO conversations_fts(rowid, user_id, message, response)
+            VALUES (new.id, new.user_id, new.message, new.response);
+        END
+    ''')
+    # Re-read every existing conversation into the index
+    conn.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
+    return True
+
+COUNTER_NAMES = ("total_users", "total_messages", "total_games_won", "active_users")
+
+def counter_truth(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Counter values recomputed from the base tables (full scan, offline use only)"""
+    users, games, active = conn.execute(
+        "SELECT COALESCE(SUM(total_messages > 0), 0), COALESCE(SUM(games_won), 0), COALESCE(SUM(COALESCE(ai_active, 0) != 0), 0) FROM user_stats"
+    ).fetchone()
+    messages = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_archive'").fetchone():
+        messages += conn.execute("SELECT COALESCE(SUM(row_count), 0) FROM conversation_archive").fetchone()[0]
+    return {"total_users": users, "total_messages": messages, "total_games_won": games, "active_users": active}
+
+def rebuild_counters(conn: sqlite3.Connection):
+    """Reset global_counters to the values derived from the base tables"""
+    conn.executemany(
+        "INSERT INTO global_counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        counter_truth(conn).items()
+    )
+
+def create_counters(conn: sqlite3.Connection):
+    """Materialized /stats counters, maintained by triggers in the same transaction as each write"""
+    conn.execute("CREATE TABLE IF NOT EXISTS global_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counter_rollups (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket, name)
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS counters_conversation_insert AFTER INSERT ON conversations BEGIN
+            UPDATE global_counters SET value = value + 1 WHERE name = 'total_messages';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS counters_user_insert AFTER INSERT ON user_stats BEGIN
+            UPDATE global_counters SET value = value + CASE name
+                WHEN 'total_users' THEN COALESCE(new.total_messages, 0) > 0
+                WHEN 'total_games_won' THEN COALESCE(new.games_won, 0)
+                WHEN 'active_users' THEN COALESCE(new.ai_active, 0) != 0
+            END
+            WHERE name IN ('total_users', 'total_games_won', 'active_users');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS counters_user_update AFTER UPDATE ON user_stats BEGIN
+            UPDATE global_counters SET value = value + CASE name
+                WHEN 'total_users' THEN (COALESCE(new.total_messages, 0) > 0) - (COALESCE(old.total_messages, 0) > 0)
+                WHEN 'total_games_won' THEN COALESCE(new.games_won, 0) - COALESCE(old.games_won, 0)
+                WHEN 'active_users' THEN (COALESCE(new.ai_active, 0) != 0) - (COALESCE(old.ai_active, 0) != 0)
+            END
+            WHERE name IN ('total_users', 'total_games_won', 'active_users');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS counters_user_delete AFTER DELETE ON user_stats BEGIN
+            UPDATE global_counters SET value = value - CASE name
+                WHEN 'total_users' THEN COALESCE(old.total_messages, 0) > 0
+                WHEN 'total_games_won' THEN COALESCE(old.games_won, 0)
+                WHEN 'active_users' THEN COALESCE(old.ai_active, 0) != 0
+            END
+            WHERE name IN ('total_users', 'total_games_won', 'active_users');
+        END
+    ''')
+    rebuild_counters(conn)
+
+ROLLUP_PERIODS = {"hour": "%Y-%m-%dT%H:00", "day": "%Y-%m-%d"}
+
+def set_rollups(conn: sqlite3.Connection, enabled: bool):
+    """Create or drop the triggers that bucket messages and game wins per hour/day"""
+    for period, bucket_format in ROLLUP_PERIODS.items():
+        if not enabled:
+            conn.execute(f"DROP TRIGGER IF EXISTS rollup_{period}_messages")
+            conn.execute(f"DROP TRIGGER IF EXISTS rollup_{period}_games_won")
+            continue
+        
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS rollup_{period}_messages AFTER INSERT ON conversations BEGIN
+                INSERT INTO counter_rollups (period, bucket, name, value)
+                VALUES ('{period}', strftime('{bucket_format}', 'now'), 'messages', 1)
+                ON CONFLICT(period, bucket, name) DO UPDATE SET value = value + 1;
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS rollup_{period}_games_won AFTER UPDATE OF games_won ON user_stats
+            WHEN COALESCE(new.games_won, 0) > COALESCE(old.games_won, 0) BEGIN
+                INSERT INTO counter_rollups (period, bucket, name, value)
+                VALUES ('{period}', strftime('{bucket_format}', 'now'), 'games_won', new.games_won - COALESCE(old.games_won, 0))
+                ON CONFLICT(period, bucket, name) DO UPDATE SET value = value + excluded.value;
+            END
+        ''')
+    conn.commit()
+
+# Ordered (version, description, step) list; a step is SQL statements or a callable(conn).
+# Never edit an applied step, append a new one instead.
+MIGRATIONS = [
+    (1, "base tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id TEXT PRIMARY KEY,
+            total_messages INTEGER DEFAULT 0,
+            games_won INTEGER DEFAULT 0,
+            ai_active BOOLEAN DEFAULT FALSE,
+            last_active DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+    (2, "user_stats.ai_active column", _add_ai_active_column),
+    (3, "per-user history index", [
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id, id)"
+    ]),
+    (4, "conversations full-text index", build_fts_index),
+    (5, "shared game states", [
+        '''
+        CREATE TABLE IF NOT EXISTS game_states (
+            user_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_game_states_expires_at ON game_states(expires_at)"
+    ]),
+    (6, "materialized global counters", create_counters),
+    (7, "rolling conversation summaries", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_through INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+    (8, "compressed conversation archive", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_archive (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_conversation_archive_user ON conversation_archive(user_id, last_id, first_id)"
+    ]),
+]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations in order, each in its own transaction. Returns the schema version."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            # Take the write lock first, then re-check: another process may have
+            # applied this step while we waited (e.g. several workers booting)
+            conn.execute("BEGIN IMMEDIATE")
+            current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            if version <= current:
+                conn.rollback()
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.execute(statement)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        current = version
+    
+    return current
+
+# Keyset pagination over conversations.id (newest first)
+MEMORY_PAGE_MAX = 100
+EXPORT_BATCH_SIZE = 500
+NO_CURSOR = 2 ** 63 - 1
+
+# Queries on the request path; check_query_plans keeps them off full table scans
+HISTORY_QUERY = "SELECT message, response FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT ?"
+HISTORY_PAGE_QUERY = "SELECT id, message, response, timestamp FROM conversations WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+USER_STATE_QUERY = "SELECT total_messages, games_won, ai_active, last_active FROM user_stats WHERE user_id = ?"
+USER_STATES_QUERY = "SELECT user_id, total_messages, games_won, ai_active, last_active FROM user_stats WHERE user_id IN ({})"
+MEMORY_SEARCH_QUERY = "SELECT message, response FROM conversations WHERE user_id = ? AND (message LIKE ? OR response LIKE ?) ORDER BY id DESC LIMIT 2"
+FTS_SEARCH_QUERY = (
+    "SELECT snippet(conversations_fts, 1, char(2), char(3), '…', 8), "
+    "snippet(conversations_fts, 2, char(2), char(3), '…', 8) FROM conversations_fts "
+    "JOIN conversations ON conversations.id = conversations_fts.rowid "
+    "WHERE conversations_fts MATCH ? AND conversations.user_id = ? "
+    "ORDER BY bm25(conversations_fts, 0.0, 1.0, 0.5) LIMIT ?"
+)
+GLOBAL_STATS_QUERY = f"SELECT name, value FROM global_counters WHERE name IN ({', '.join(repr(name) for name in COUNTER_NAMES)})"
+ROLLUP_QUERY = "SELECT bucket, name, value FROM counter_rollups WHERE period = ? AND bucket >= ? ORDER BY bucket"
+SUMMARY_QUERY = "SELECT summary, summarized_through FROM user_summaries WHERE user_id = ?"
+# Oldest unsummarized turns first, stopping before the newest ones (the OFFSET-th
+# newest turn and everything after it stays in the packed history)
+UNSUMMARIZED_QUERY = (
+    "SELECT id, message, response FROM conversations WHERE user_id = ? AND id > ? AND id < "
+    "(SELECT id FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?) "
+    "ORDER BY id LIMIT ?"
+)
+ARCHIVE_CANDIDATES_QUERY = "SELECT id, user_id, message, response, timestamp FROM conversations ORDER BY id LIMIT ?"
+ARCHIVE_BLOCKS_QUERY = "SELECT id, first_id, last_id FROM conversation_archive WHERE user_id = ? ORDER BY last_id DESC"
+SUMMARY_UPSERT = (
+    "INSERT INTO user_summaries (user_id, summary, summarized_through, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, summarized_through = excluded.summarized_through, "
+    "updated_at = excluded.updated_at WHERE excluded.summarized_through > user_summaries.summarized_through"
+)
+
+HOT_QUERIES = {
+    "history": (HISTORY_QUERY, ("user", 10)),
+    "history_page": (HISTORY_PAGE_QUERY, ("user", 1000, 100)),
+    "user_state": (USER_STATE_QUERY, ("user",)),
+    "user_states": (USER_STATES_QUERY.format("?, ?"), ("user", "other")),
+    "memory_search": (MEMORY_SEARCH_QUERY, ("user", "%x%", "%x%")),
+    "global_stats": (GLOBAL_STATS_QUERY, ()),
+    "summary": (SUMMARY_QUERY, ("user",)),
+    "unsummarized": (UNSUMMARIZED_QUERY, ("user", 0, "user", 3, 50)),
+    "archive_blocks": (ARCHIVE_BLOCKS_QUERY, ("user",)),
+}
+
+def check_query_plans(conn: sqlite3.Connection) -> List[str]:
+    """EXPLAIN QUERY PLAN every hot query; return a problem per table scan or temp sort"""
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            if re.match(r"SCAN \w+$", detail) or "USE TEMP B-TREE FOR ORDER BY" in detail:
+                problems.append(f"{name}: {detail}")
+    return problems
+
+class SQLitePool:
+    """Pooled SQLite connections in WAL mode with a single writer.
+
+    Readers check out an idle connection (WAL lets them run alongside the writer);
+    all writes go through one connection behind a lock, in BEGIN IMMEDIATE transactions.
+    """
+
+    def __init__(self, path: str, size: int = 8, busy_timeout_ms: int = 5000,
+                 synchronous: str = "NORMAL", mmap_size: int = 256 * 1024 * 1024):
+        self.path = path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._readers = 0  # reader connections opened or being opened
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            grow = self._readers < self.size
+            if grow:
+                self._readers += 1  # reserve the slot before connecting outside the lock
+        if grow:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._readers -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.busy_timeout_ms / 1000)
+        except queue.Empty:
+            raise TimeoutError(
+                f"No idle SQLite reader for {self.path} after {self.busy_timeout_ms}ms "
+                f"(all {self.size} in use; raise SQLITE_POOL_SIZE)"
+            ) from None
+
+    @contextmanager
+    def read(self):
+        """Cursor on a pooled reader connection"""
+        conn = self._checkout()
+        try:
+            yield conn.cursor()
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    @contextmanager
+    def write(self):
+        """Cursor inside a write transaction, committed on exit (nested calls join the outer one)"""
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            if self._writer.in_transaction:
+                yield cursor
+                return
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def exclusive(self):
+        """Raw writer connection for DDL and migrations, which manage their own transactions"""
+        with self._write_lock:
+            yield self._writer
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._readers = 0
+
+    @classmethod
+    def from_env(cls, path: str) -> "SQLitePool":
+        return cls(
+            path,
+            size=int(os.getenv("SQLITE_POOL_SIZE", 8)),
+            busy_timeout_ms=int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+            synchronous=os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+            mmap_size=int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+        )
+
+class ShardedStore:
+    """SQLite storage hash-partitioned by user_id across `shards` database files.
+
+    A user's rows all live on shard crc32(user_id) % shards. Changing the shard
+    count means new files, filled by `reshard`; with one shard the store is just
+    the plain database file.
+    """
+
+    def __init__(self, db_path: str, shards: int = 1):
+        self.paths = self.shard_paths(db_path, shards)
+        self.pools = [SQLitePool.from_env(path) for path in self.paths]
+
+    @staticmethod
+    def shard_paths(db_path: str, shards: int) -> List[str]:
+        if shards <= 1:
+            return [db_path]
+        stem, ext = os.path.splitext(db_path)
+        return [f"{stem}.{index}-of-{shards}{ext}" for index in range(shards)]
+
+    def __len__(self) -> int:
+        return len(self.pools)
+
+    def index(self, user_id: str) -> int:
+        return zlib.crc32(user_id.encode()) % len(self.pools)
+
+    def for_user(self, user_id: str) -> SQLitePool:
+        return self.pools[self.index(user_id)]
+
+    def read(self, user_id: str):
+        return self.for_user(user_id).read()
+
+    def write(self, user_id: str):
+        return self.for_user(user_id).write()
+
+    def group(self, user_ids: List[str]) -> Dict[int, List[str]]:
+        """user_ids bucketed by shard index, order kept within each bucket"""
+        groups: Dict[int, List[str]] = {}
+        for user_id in user_ids:
+            groups.setdefault(self.index(user_id), []).append(user_id)
+        return groups
+
+    def migrate(self, rollups: Optional[bool] = None) -> int:
+        """Bring every shard to the latest schema (and set rollups unless None); returns the schema version"""
+        version = 0
+        for db in self.pools:
+            with db.exclusive() as conn:
+                version = migrate(conn)
+                if rollups is not None:
+                    set_rollups(conn, rollups)
+        return version
+
+    def close(self):
+        for db in self.pools:
+            db.close()
+
+    @classmethod
+    def from_env(cls, db_path: str, shards: Optional[int] = None) -> "ShardedStore":
+        return cls(db_path, shards if shards is not None else int(os.getenv("HARSHA_SHARDS", 1)))
+
+class ConversationWriter:
+    """Write-behind queue that group-commits conversation rows and stat increments.
+
+    durability: "sync" commits inline, "group" queues and waits for its batch to
+    commit, "async" queues and returns at once. Queued writes stay visible to
+    their user through read_your_writes() until their batch commits.
+    on_commit, if set, gets the committed (id, user_id, message, response) rows.
+    With id_stride > 1 (sharding) new ids are the next ones congruent to
+    id_offset, so ids never collide across shards and rows can be resharded as-is.
+    """
+
+    def __init__(self, db: SQLitePool, durability: str = "async", batch_size: int = 100,
+                 flush_interval: float = 0.05, max_queue: int = 10000, on_commit=None,
+                 id_stride: int = 1, id_offset: int = 0):
+        self.db = db
+        self.on_commit = on_commit
+        self.id_stride = id_stride
+        self.id_offset = id_offset
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=max_queue)
+        self._pending: Dict[str, List[Dict]] = {}
+        self._lock = threading.Lock()
+        # Orders enqueues against close(), so nothing lands behind the stop sentinel
+        self._submit_lock = threading.Lock()
+        self._closed = False
+        self.batches = 0
+        self.rows = 0
+        
+        self._thread = None
+        if durability != "sync":
+            self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+            self._thread.start()
+
+    def save_conversation(self, user_id: str, message: str, response: str, timestamp: str):
+        self._submit({"kind": "conversation", "user_id": user_id, "message": message,
+                      "response": response, "timestamp": timestamp})
+
+    def record_game_win(self, user_id: str):
+        self._submit({"kind": "game_win", "user_id": user_id})
+
+    def _submit(self, op: Dict):
+        if self.durability == "group":
+            op["done"] = threading.Event()
+        with self._submit_lock:
+            queued = self._thread is not None and not self._closed
+            if queued:
+                with self._lock:
+                    self._pending.setdefault(op["user_id"], []).append(op)
+                try:
+                    self._queue.put_nowait(op)
+                except queue.Full:
+                    # Queue memory is bounded: past the limit, callers pay for their own commit
+                    queued = False
+        if not queued:
+            self._commit([op])
+            return
+        
+        if "done" in op:
+            op["done"].wait()
+
+    def read_your_writes(self, user_id: str, read):
+        """Run read() against the DB and return (result, this user's uncommitted ops).
+
+        Holding the lock keeps a batch from committing between the two reads, so
+        a row is never missed or seen twice.
+        """
+        with self._lock:
+            pending = list(self._pending.get(user_id, ()))
+            if pending:
+                return read(), pending
+        return read(), []
+
+    def read_your_writes_many(self, user_ids: List[str], read):
+        """read_your_writes() for several users: (result, {user_id: uncommitted ops})"""
+        with self._lock:
+            pending = {user_id: list(self._pending[user_id]) for user_id in user_ids if user_id in self._pending}
+            if pending:
+                return read(), pending
+        return read(), {}
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                op = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if op is None:
+                break
+            
+            batch = [op]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    op = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if op is None:
+                    stopping = True
+                    break
+                batch.append(op)
+            self._commit(batch)
+        
+        # Flush whatever is left on shutdown
+        leftover = []
+        while True:
+            try:
+                op = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if op is not None:
+                leftover.append(op)
+        for start in range(0, len(leftover), self.batch_size):
+            self._commit(leftover[start:start + self.batch_size])
+
+    def _commit(self, batch: List[Dict]):
+        conversations = []
+        messages: Dict[str, List] = {}
+        wins: Dict[str, int] = {}
+        for op in batch:
+            if op["kind"] == "conversation":
+                conversations.append((op["user_id"], op["message"], op["response"]))
+                count = messages.setdefault(op["user_id"], [0, None])
+                count[0] += 1
+                count[1] = op["timestamp"]
+            elif op["kind"] == "game_win":
+                wins[op["user_id"]] = wins.get(op["user_id"], 0) + 1
+        
+        committed = []
+        try:
+            with self._lock:
+                try:
+                    with self.db.write() as cursor:
+                        # Row by row for the new ids; still one transaction per batch
+                        if self.id_stride == 1:
+                            for row in conversations:
+                                cursor.execute("INSERT INTO conversations (user_id, message, response) VALUES (?, ?, ?)", row)
+                                committed.append((cursor.lastrowid,) + row)
+                        elif conversations:
+                            # sqlite_sequence is the highest id ever used here, archived rows included
+                            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'conversations'")
+                            next_id = (cursor.fetchone() or (0,))[0] + 1
+                            next_id += (self.id_offset - next_id) % self.id_stride
+                            for row in conversations:
+                                cursor.execute("INSERT INTO conversations (id, user_id, message, response) VALUES (?, ?, ?, ?)", (next_id,) + row)
+                                committed.append((next_id,) + row)
+                                next_id += self.id_stride
+                        # Update stats (preserve ai_active status)
+                        cursor.executemany(
+                            "INSERT INTO user_stats (user_id, last_active, total_messages, ai_active, games_won) VALUES (?, ?, ?, 0, 0) "
+                            "ON CONFLICT(user_id) DO UPDATE SET total_messages = COALESCE(total_messages, 0) + excluded.total_messages, last_active = excluded.last_active",
+                            [(user_id, last_active, count) for user_id, (count, last_active) in messages.items()]
+                        )
+                        cursor.executemany(
+                            "UPDATE user_stats SET games_won = COALESCE(games_won, 0) + ? WHERE user_id = ?",
+                            [(count, user_id) for user_id, count in wins.items()]
+                        )
+                    self.batches += 1
+                    self.rows += len(batch)
+                except Exception:
+                    committed = []
+                    raise
+                finally:
+                    for op in batch:
+                        pending = self._pending.get(op["user_id"])
+                        if pending and op in pending:
+                            pending.remove(op)
+                            if not pending:
+                                del self._pending[op["user_id"]]
+            if committed and self.on_commit:
+                self.on_commit(committed)
+        except Exception as e:
+            print(f"Save error: {e}")
+        finally:
+            for op in batch:
+                if "done" in op:
+                    op["done"].set()
+
+    def close(self):
+        """Stop the background thread after flushing everything queued"""
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self) -> Dict:
+        return {
+            "durability": self.durability,
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "rows": self.rows
+        }
+
+    @classmethod
+    def from_env(cls, db: SQLitePool, on_commit=None, id_stride: int = 1, id_offset: int = 0) -> "ConversationWriter":
+        return cls(
+            db,
+            on_commit=on_commit,
+            id_stride=id_stride,
+            id_offset=id_offset,
+            durability=os.getenv("CONVERSATION_DURABILITY", "async").lower(),
+            batch_size=int(os.getenv("WRITE_BATCH_SIZE", 100)),
+            flush_interval=float(os.getenv("WRITE_FLUSH_MS", 50)) / 1000,
+            max_queue=int(os.getenv("WRITE_QUEUE_SIZE", 10000))
+        )
+
+class ShardedWriter:
+    """A ConversationWriter per shard behind the single-writer interface.
+
+    Shards have their own queue and write lock, so batches for different
+    shards commit in parallel.
+    """
+
+    def __init__(self, store: ShardedStore, on_commit=None):
+        self.store = store
+        self.writers = [
+            ConversationWriter.from_env(db, on_commit=on_commit, id_stride=len(store), id_offset=index)
+            for index, db in enumerate(store.pools)
+        ]
+
+    def for_user(self, user_id: str) -> ConversationWriter:
+        return self.writers[self.store.index(user_id)]
+
+    def save_conversation(self, user_id: str, message: str, response: str, timestamp: str):
+        self.for_user(user_id).save_conversation(user_id, message, response, timestamp)
+
+    def record_game_win(self, user_id: str):
+        self.for_user(user_id).record_game_win(user_id)
+
+    def read_your_writes(self, user_id: str, read):
+        return self.for_user(user_id).read_your_writes(user_id, read)
+
+    def read_your_writes_many(self, user_ids: List[str], read):
+        """read_your_writes_many() for users that all live on one shard"""
+        return self.for_user(user_ids[0]).read_your_writes_many(user_ids, read)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def stats(self) -> Dict:
+        shards = [writer.stats() for writer in self.writers]
+        return {
+            "durability": shards[0]["durability"],
+            "shards": len(shards),
+            "queued": sum(shard["queued"] for shard in shards),
+            "batches": sum(shard["batches"] for shard in shards),
+            "rows": sum(shard["rows"] for shard in shards)
+        }
+
+def _set_sequence(cursor: sqlite3.Cursor, seq: int):
+    """Raise the conversations AUTOINCREMENT high-water mark to at least `seq`"""
+    cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'conversations'", (seq,))
+    if not cursor.rowcount:
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('conversations', ?)", (seq,))
+
+def reshard(source: ShardedStore, target: ShardedStore, batch_size: int = EXPORT_BATCH_SIZE) -> Dict[str, int]:
+    """Copy everything from the `source` shard layout into `target`; safe to run while serving.
+
+    Conversations keep their ids and are copied incrementally (progress lives in
+    reshard_progress on target shard 0), so a rerun only copies what was written
+    since. user_stats, summaries, game states and archive blocks are re-copied in
+    full each run. Run once live, then again with writes stopped, then switch
+    HARSHA_SHARDS and restart.
+    """
+    if source.paths == target.paths:
+        raise ValueError("source and target are the same shard layout")
+    target.migrate(rollups=False)  # copied rows must not count as new traffic
+    copied = {"conversations": 0, "users": 0, "archive_blocks": 0}
+    
+    with target.pools[0].write() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS reshard_progress (source TEXT PRIMARY KEY, last_id INTEGER NOT NULL)")
+    
+    high_water = 0
+    for path, db in zip(source.paths, source.pools):
+        with target.pools[0].read() as cursor:
+            cursor.execute("SELECT last_id FROM reshard_progress WHERE source = ?", (path,))
+            last_id = (cursor.fetchone() or (0,))[0]
+        
+        while True:
+            # Ids are assigned inside the write transaction, so they commit in order
+            with db.read() as cursor:
+                cursor.execute(
+                    "SELECT id, user_id, message, response, timestamp FROM conversations WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            for index, user_ids in target.group([row[1] for row in rows]).items():
+                wanted = set(user_ids)
+                with target.pools[index].write() as cursor:
+                    cursor.executemany(
+                        "INSERT OR IGNORE INTO conversations (id, user_id, message, response, timestamp) VALUES (?, ?, ?, ?, ?)",
+                        [row for row in rows if row[1] in wanted]
+                    )
+            last_id = rows[-1][0]
+            copied["conversations"] += len(rows)
+            with target.pools[0].write() as cursor:
+                cursor.execute(
+                    "INSERT INTO reshard_progress (source, last_id) VALUES (?, ?) ON CONFLICT(source) DO UPDATE SET last_id = excluded.last_id",
+                    (path, last_id)
+                )
+        
+        with db.read() as cursor:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'conversations'")
+            high_water = max(high_water, (cursor.fetchone() or (0,))[0])
+            cursor.execute("SELECT user_id, last_active, total_messages, ai_active, games_won FROM user_stats")
+            stats = cursor.fetchall()
+            cursor.execute("SELECT user_id, summary, summarized_through, updated_at FROM user_summaries")
+            summaries = cursor.fetchall()
+            cursor.execute("SELECT user_id, state, expires_at FROM game_states")
+            games = cursor.fetchall()
+        for table, sql, rows in (
+            ("user_stats", "INSERT OR REPLACE INTO user_stats (user_id, last_active, total_messages, ai_active, games_won) VALUES (?, ?, ?, ?, ?)", stats),
+            ("user_summaries", "INSERT OR REPLACE INTO user_summaries (user_id, summary, summarized_through, updated_at) VALUES (?, ?, ?, ?)", summaries),
+            ("game_states", "INSERT OR REPLACE INTO game_states (user_id, state, expires_at) VALUES (?, ?, ?)", games),
+        ):
+            for index, user_ids in target.group([row[0] for row in rows]).items():
+                wanted = set(user_ids)
+                with target.pools[index].write() as cursor:
+                    cursor.executemany(sql, [row for row in rows if row[0] in wanted])
+        copied["users"] += len(stats)
+        
+        # Archive blocks replace the target's copy per user, along with any hot rows
+        # that were archived at the source after they were copied
+        with db.read() as cursor:
+            cursor.execute("SELECT DISTINCT user_id FROM conversation_archive")
+            archived_users = [row[0] for row in cursor.fetchall()]
+        for user_id in archived_users:
+            with db.read() as cursor:
+                cursor.execute(
+                    "SELECT user_id, first_id, last_id, row_count, codec, data FROM conversation_archive WHERE user_id = ? ORDER BY last_id",
+                    (user_id,)
+                )
+                blocks = cursor.fetchall()
+            with target.write(user_id) as cursor:
+                cursor.execute("DELETE FROM conversation_archive WHERE user_id = ?", (user_id,))
+                cursor.executemany(
+                    "INSERT INTO conversation_archive (user_id, first_id, last_id, row_count, codec, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    blocks
+                )
+                cursor.execute("DELETE FROM conversations WHERE user_id = ? AND id <= ?", (user_id, blocks[-1][2]))
+            copied["archive_blocks"] += len(blocks)
+    
+    rollups: Dict[tuple, int] = {}
+    for db in source.pools:
+        with db.read() as cursor:
+            cursor.execute("SELECT period, bucket, name, value FROM counter_rollups")
+            for period, bucket, name, value in cursor.fetchall():
+                rollups[(period, bucket, name)] = rollups.get((period, bucket, name), 0) + value
+    
+    for index, db in enumerate(target.pools):
+        with db.write() as cursor:
+            # New ids on every target shard start above every id ever used at the source
+            _set_sequence(cursor, high_water)
+            cursor.execute("DELETE FROM counter_rollups")
+            if index == 0:
+                cursor.executemany(
+                    "INSERT INTO counter_rollups (period, bucket, name, value) VALUES (?, ?, ?, ?)",
+                    [key + (value,) for key, value in rollups.items()]
+                )
+        with db.exclusive() as conn:
+            rebuild_counters(conn)
+            conn.commit()
+    return copied
+
+def compress_block(turns: List[list]) -> Tuple[str, bytes]:
+    """(codec, blob) for a list of [id, message, response, timestamp] turns"""
+    payload = json.dumps(turns, separators=(",", ":")).encode()
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=9).compress(payload)
+    return "zlib", zlib.compress(payload, 9)
+
+def decompress_block(codec: str, data: bytes) -> List[list]:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd archive blocks")
+        payload = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        payload = zlib.decompress(data)
+    return json.loads(payload)
+
+class ConversationArchive:
+    """Cold tier: turns older than `max_age_days` leave `conversations` for
+    compressed per-user blocks in conversation_archive.
+
+    Compaction always takes the oldest rows by id, so each user's archived ids
+    sit below all of their hot ids and readers just continue into the archive
+    once the hot table runs out. Blocks are topped up to `block_rows` turns.
+    Each shard is compacted on its own.
+    """
+
+    def __init__(self, store: ShardedStore, max_age_days: float = 0, batch_size: int = 1000,
+                 block_rows: int = 256, interval: float = 300.0):
+        self.store = store
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.block_rows = block_rows
+        self.interval = interval
+        self.rows_archived = 0
+        self.runs = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def compact(self) -> int:
+        """Archive one batch of expired turns per shard; returns how many were moved"""
+        return sum(self.compact_shard(db) for db in self.store.pools)
+
+    def compact_shard(self, db: SQLitePool) -> int:
+        """Archive one batch of expired turns from one shard"""
+        if self.max_age_days <= 0:
+            return 0
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+        with db.write() as cursor:
+            cursor.execute(ARCHIVE_CANDIDATES_QUERY, (self.batch_size,))
+            expired = []
+            for row in cursor.fetchall():
+                if (row[4] or "") >= cutoff:
+                    break  # ids follow insertion time, so nothing after this is older
+                expired.append(row)
+            if not expired:
+                return 0
+            
+            by_user: Dict[str, List[list]] = {}
+            for conversation_id, user_id, message, response, timestamp in expired:
+                by_user.setdefault(user_id, []).append([conversation_id, message, response, timestamp])
+            
+            for user_id, turns in by_user.items():
+                cursor.execute(
+                    "SELECT id, codec, data, row_count FROM conversation_archive WHERE user_id = ? ORDER BY last_id DESC LIMIT 1",
+                    (user_id,)
+                )
+                latest = cursor.fetchone()
+                if latest and latest[3] < self.block_rows:
+                    turns = decompress_block(latest[1], latest[2]) + turns
+                    cursor.execute("DELETE FROM conversation_archive WHERE id = ?", (latest[0],))
+                for start in range(0, len(turns), self.block_rows):
+                    block = turns[start:start + self.block_rows]
+                    codec, data = compress_block(block)
+                    cursor.execute(
+                        "INSERT INTO conversation_archive (user_id, first_id, last_id, row_count, codec, data) VALUES (?, ?, ?, ?, ?, ?)",
+                        (user_id, block[0][0], block[-1][0], len(block), codec, data)
+                    )
+            
+            cursor.executemany("DELETE FROM conversations WHERE id = ?", [(row[0],) for row in expired])
+        
+        self.rows_archived += len(expired)
+        return len(expired)
+
+    def _blocks(self, user_id: str) -> List[tuple]:
+        """(block id, first_id, last_id) for the user's blocks, newest first"""
+        with self.store.read(user_id) as cursor:
+            cursor.execute(ARCHIVE_BLOCKS_QUERY, (user_id,))
+            return cursor.fetchall()
+
+    def _block_turns(self, user_id: str, block_id: int) -> List[list]:
+        with self.store.read(user_id) as cursor:
+            cursor.execute("SELECT codec, data FROM conversation_archive WHERE id = ?", (block_id,))
+            row = cursor.fetchone()
+        return decompress_block(*row) if row else []
+
+    def turns(self, user_id: str, before_id: Optional[int] = None) -> Iterator[Dict]:
+        """Archived turns older than `before_id`, newest first, one block at a time"""
+        before_id = before_id or NO_CURSOR
+        for block_id, first_id, last_id in self._blocks(user_id):
+            if first_id >= before_id:
+                continue
+            for conversation_id, message, response, timestamp in reversed(self._block_turns(user_id, block_id)):
+                if conversation_id < before_id:
+                    yield {"id": conversation_id, "message": message, "response": response, "timestamp": timestamp}
+
+    def lookup(self, user_id: str, ids: List[int]) -> Dict[int, str]:
+        """Messages for archived conversation ids"""
+        wanted = set(ids)
+        found = {}
+        for block_id, first_id, last_id in self._blocks(user_id):
+            if any(first_id <= conversation_id <= last_id for conversation_id in wanted):
+                for conversation_id, message, _, _ in self._block_turns(user_id, block_id):
+                    if conversation_id in wanted:
+                        found[conversation_id] = message
+        return found
+
+    def search(self, user_id: str, topic: str, limit: int = 2) -> List[str]:
+        """Archived messages mentioning `topic`, newest first (decompresses this user's blocks only)"""
+        needle = topic.lower()
+        matches = []
+        for turn in self.turns(user_id):
+            if needle in turn["message"].lower() or needle in turn["response"].lower():
+                matches.append(turn["message"])
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                # Drain the backlog a batch (one short write transaction) at a time
+                backlog = list(self.store.pools)
+                while backlog and not self._stop.is_set():
+                    backlog = [db for db in backlog if self.compact_shard(db) == self.batch_size]
+                self.runs += 1
+            except Exception as e:
+                print(f"Archive error: {e}")
+
+    def start(self):
+        """Compact in the background every `interval` seconds (no-op when max_age_days <= 0)"""
+        if self.max_age_days > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="conversation-archiver", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self) -> Dict:
+        return {
+            "max_age_days": self.max_age_days,
+            "codec": "zstd" if zstandard is not None else "zlib",
+            "rows_archived": self.rows_archived,
+            "runs": self.runs
+        }
+
+    @classmethod
+    def from_env(cls, store: ShardedStore) -> "ConversationArchive":
+        return cls(
+            store,
+            max_age_days=float(os.getenv("ARCHIVE_AFTER_DAYS", 0)),
+            batch_size=int(os.getenv("ARCHIVE_BATCH_SIZE", 1000)),
+            block_rows=int(os.getenv("ARCHIVE_BLOCK_ROWS", 256)),
+            interval=float(os.getenv("ARCHIVE_INTERVAL_S", 300))
+        )
+
+class Embedder(ABC):
+    """Turns texts into unit-length float32 vectors (dot product = cosine similarity)"""
+
+    name = "embedder"
+    dim = 0
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        ...
+
+    @staticmethod
+    def normalize(vectors: "np.ndarray") -> "np.ndarray":
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    @staticmethod
+    def from_env() -> "Embedder":
+        backend = os.getenv("EMBEDDER", "hashing").lower()
+        if backend == "azure":
+            return AzureEmbedder(
+                deployment=os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-3-small"),
+                dim=int(os.getenv("EMBEDDING_DIM", 1536))
+            )
+        return HashingEmbedder(dim=int(os.getenv("EMBEDDING_DIM", 256)))
+
+class HashingEmbedder(Embedder):
+    """Offline embedder: signed feature hashing of words and character trigrams.
+
+    Catches shared words and spelling variants ("pizza"/"pizzas"), not synonyms.
+    Uses crc32 rather than hash() so vectors are stable across processes.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    @staticmethod
+    def features(text: str) -> Iterator[Tuple[str, float]]:
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            yield f"w:{word}", 1.0
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                yield f"c:{padded[i:i + 3]}", 0.5
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self.features(text):
+                hashed = zlib.crc32(feature.encode())
+                vectors[row, hashed % self.dim] += weight if hashed & 0x80000000 else -weight
+        return self.normalize(vectors)
+
+class AzureEmbedder(Embedder):
+    """Azure OpenAI embeddings deployment"""
+
+    name = "azure"
+
+    def __init__(self, deployment: str, dim: int = 1536):
+        self.deployment = deployment
+        self.dim = dim
+        self.client = AzureOpenAI(
+            api_version=os.getenv("AZURE_API_VERSION", "2024-12-01-preview"),
+            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            http_client=httpx.Client(**AzureBackend.http_config())
+        )
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        response = self.client.embeddings.create(model=self.deployment, input=texts, dimensions=self.dim)
+        return self.normalize(np.array([item.embedding for item in response.data], dtype=np.float32))
+
+class VectorIndex:
+    """Per-user embedding matrices in append-only, memory-mapped files.
+
+    Each record is (conversation id, unit vector), so recall is a dot product
+    over one user's file followed by a primary-key lookup; the conversations
+    table is never scanned. Records are appended in a single write, which keeps
+    files from several workers consistent.
+    """
+
+    CHUNK_ROWS = 8192
+
+    def __init__(self, root: str, embedder: Embedder, min_score: float = 0.3, max_open: int = 1024):
+        self.embedder = embedder
+        self.min_score = min_score
+        self.max_open = max_open
+        self.root = os.path.join(root, f"{embedder.name}-{embedder.dim}")
+        self.dtype = np.dtype([("id", "<i8"), ("vec", "<f4", (embedder.dim,))])
+        self._maps: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.rows_added = 0
+        self.searches = 0
+
+    def path(self, user_id: str) -> str:
+        digest = hashlib.sha1(user_id.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}.vec")
+
+    def add(self, rows: List[Tuple[int, str, str]]):
+        """Embed and append (conversation id, user_id, text) rows"""
+        by_user: Dict[str, List[Tuple[int, str]]] = {}
+        for conversation_id, user_id, text in rows:
+            by_user.setdefault(user_id, []).append((conversation_id, text))
+        
+        vectors = self.embedder.embed([text for items in by_user.values() for _, text in items])
+        offset = 0
+        for user_id, items in by_user.items():
+            records = np.empty(len(items), dtype=self.dtype)
+            records["id"] = [conversation_id for conversation_id, _ in items]
+            records["vec"] = vectors[offset:offset + len(items)]
+            offset += len(items)
+            
+            path = self.path(user_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(records.tobytes())
+        self.rows_added += len(rows)
+
+    def records(self, user_id: str) -> Optional["np.ndarray"]:
+        """This user's records as a read-only memmap (reopened when the file grows)"""
+        path = self.path(user_id)
+        try:
+            count = os.path.getsize(path) // self.dtype.itemsize
+        except OSError:
+            return None
+        if not count:
+            return None
+        
+        with self._lock:
+            cached = self._maps.get(user_id)
+            if cached and cached[0] == count:
+                self._maps.move_to_end(user_id)
+                return cached[1]
+            records = np.memmap(path, dtype=self.dtype, mode="r", shape=(count,))
+            self._maps[user_id] = (count, records)
+            self._maps.move_to_end(user_id)
+            while len(self._maps) > self.max_open:
+                self._maps.popitem(last=False)
+            return records
+
+    def search(self, user_id: str, queries: "np.ndarray", k: int = 2) -> List[List[Tuple[int, float]]]:
+        """Top-k (conversation id, cosine) per query row, best first, at or above min_score"""
+        self.searches += 1
+        records = self.records(user_id)
+        if records is None:
+            return [[] for _ in queries]
+        
+        scores = np.empty((len(queries), len(records)), dtype=np.float32)
+        for start in range(0, len(records), self.CHUNK_ROWS):
+            block = records["vec"][start:start + self.CHUNK_ROWS]
+            scores[:, start:start + len(block)] = queries @ block.T
+        
+        ids = records["id"]
+        results = []
+        for row in scores:
+            top = min(len(row), k * 2)  # headroom for ids indexed twice
+            best = np.argpartition(-row, top - 1)[:top]
+            hits, seen = [], set()
+            for i in best[np.argsort(-row[best])]:
+                conversation_id = int(ids[i])
+                if row[i] < self.min_score or conversation_id in seen:
+                    continue
+                seen.add(conversation_id)
+                hits.append((conversation_id, float(row[i])))
+            results.append(hits[:k])
+        return results
+
+    def clear(self):
+        """Delete every file for the current embedder"""
+        shutil.rmtree(self.root, ignore_errors=True)
+        with self._lock:
+            self._maps.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "embedder": self.embedder.name,
+            "dim": self.embedder.dim,
+            "open_users": len(self._maps),
+            "rows_added": self.rows_added,
+            "searches": self.searches
+        }
+
+    @classmethod
+    def from_env(cls, db_path: str) -> Optional["VectorIndex"]:
+        if os.getenv("VECTOR_INDEX", "1") != "1":
+            return None
+        if np is None:
+            print("⚠️ numpy not installed, semantic recall disabled")
+            return None
+        return cls(
+            os.getenv("VECTOR_INDEX_DIR", f"{db_path}.vectors"),
+            Embedder.from_env(),
+            min_score=float(os.getenv("VECTOR_MIN_SCORE", 0.3))
+        )
+
+class GameStateStore(ABC):
+    """Where in-progress games live between messages; entries expire after `ttl` seconds"""
+
+    def __init__(self, ttl: float = 900, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @abstractmethod
+    def get(self, user_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def set(self, user_id: str, state: Dict):
+        ...
+
+    @abstractmethod
+    def delete(self, user_id: str):
+        ...
+
+    @staticmethod
+    def from_env(store: ShardedStore) -> "GameStateStore":
+        ttl = float(os.getenv("GAME_STATE_TTL", 900))
+        max_size = int(os.getenv("GAME_STATE_MAX", 10000))
+        if os.getenv("GAME_STATE_BACKEND", "memory").lower() == "sqlite":
+            return SQLiteGameStateStore(store, ttl, max_size)
+        return MemoryGameStateStore(ttl, max_size)
+
+class MemoryGameStateStore(GameStateStore):
+    """Per-process game states, bounded LRU with lazy expiry"""
+
+    def __init__(self, ttl: float = 900, max_size: int = 10000):
+        super().__init__(ttl, max_size)
+        self._states: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._states.get(user_id)
+            if not entry:
+                return None
+            if entry[0] <= time.time():
+                del self._states[user_id]
+                return None
+            return dict(entry[1])
+
+    def set(self, user_id: str, state: Dict):
+        with self._lock:
+            self._states[user_id] = (time.time() + self.ttl, dict(state))
+            self._states.move_to_end(user_id)
+            # Oldest games go first, whether expired or just over the bound
+            while self._states and (len(self._states) > self.max_size
+                                    or next(iter(self._states.values()))[0] <= time.time()):
+                self._states.popitem(last=False)
+
+    def delete(self, user_id: str):
+        with self._lock:
+            self._states.pop(user_id, None)
+
+class SQLiteGameStateStore(GameStateStore):
+    """Game states in the game_states table of the user's shard, shared by every worker"""
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, store: ShardedStore, ttl: float = 900, max_size: int = 10000):
+        super().__init__(ttl, max_size)
+        self.store = store
+        self._writes = 0
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        with self.store.read(user_id) as cursor:
+            cursor.execute("SELECT state FROM game_states WHERE user_id = ? AND expires_at > ?", (user_id, time.time()))
+            row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, user_id: str, state: Dict):
+        with self.store.write(user_id) as cursor:
+            cursor.execute(
+                "INSERT INTO game_states (user_id, state, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at",
+                (user_id, json.dumps(state), time.time() + self.ttl)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self.prune(cursor)
+
+    def delete(self, user_id: str):
+        with self.store.write(user_id) as cursor:
+            cursor.execute("DELETE FROM game_states WHERE user_id = ?", (user_id,))
+
+    def prune(self, cursor: sqlite3.Cursor):
+        """Drop expired games, then the soonest-to-expire ones beyond max_size (per shard)"""
+        cursor.execute("DELETE FROM game_states WHERE expires_at <= ?", (time.time(),))
+        cursor.execute(
+            "DELETE FROM game_states WHERE user_id IN (SELECT user_id FROM game_states ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+
+# Per-request stage timings, filled by Metrics.timer() while a trace is active
+_request_trace: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_trace", default=None)
+
+class Metrics:
+    """Hot-path counters and histograms, rendered in Prometheus text format"""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    TOKEN_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    DESCRIPTIONS = {
+        "harsha_request_seconds": ("histogram", "End-to-end /chat processing time"),
+        "harsha_stage_seconds": ("histogram", "Time spent per process_message stage"),
+        "harsha_path_total": ("counter", "Messages by the path that answered them"),
+        "harsha_function_calls_total": ("counter", "AI function calls by function"),
+        "harsha_llm_tokens": ("histogram", "LLM token usage per completion"),
+        "harsha_slow_requests_total": ("counter", "Requests slower than SLOW_REQUEST_MS"),
+        "harsha_llm_failures_total": ("counter", "Failed LLM completions by stage"),
+        "harsha_llm_skipped_total": ("counter", "LLM calls skipped for an open circuit or spent deadline"),
+        "harsha_summaries_total": ("counter", "Rolling user summaries refreshed"),
+        "harsha_duplicate_requests_total": ("counter", "Webhook retries answered from an earlier delivery"),
+        "harsha_coalesced_messages_total": ("counter", "Messages folded into a later message's AI reply"),
+        "harsha_response_cache_hits_total": ("counter", "Replies served from the response cache by tier"),
+    }
+
+    def __init__(self, slow_request_ms: float = 0):
+        self.slow_request_ms = slow_request_ms
+        self._lock = threading.Lock()
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, List] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Optional[Dict]) -> tuple:
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name: str, labels: Optional[Dict] = None, value: float = 1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict] = None, buckets: tuple = LATENCY_BUCKETS):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def path(self, path: str):
+        self.inc("harsha_path_total", {"path": path})
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("harsha_stage_seconds", elapsed, {"stage": stage})
+            trace = _request_trace.get()
+            if trace is not None:
+                trace[stage] = trace.get(stage, 0.0) + elapsed
+
+    @contextmanager
+    def trace(self):
+        """Collect this request's stage timings (shared with asyncio.to_thread workers)"""
+        trace: Dict[str, float] = {}
+        token = _request_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _request_trace.reset(token)
+
+    def finish_request(self, user_id: str, elapsed: float, trace: Dict[str, float]):
+        self.observe("harsha_request_seconds", elapsed)
+        if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+            self.inc("harsha_slow_requests_total")
+            stages = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in trace.items())
+            print(f"🐢 Slow request for {user_id}: {elapsed * 1000:.0f}ms ({stages})")
+
+    def record_usage(self, stage: str, response):
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return
+        for kind in ("prompt_tokens", "completion_tokens"):
+            count = getattr(usage, kind, None)
+            if count is not None:
+                self.observe("harsha_llm_tokens", count, {"stage": stage, "kind": kind.split("_")[0]}, self.TOKEN_BUCKETS)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [
+            f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for name, value in labels
+        ]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """Prometheus text exposition; `gauges` are point-in-time values from other components"""
+        lines = []
+        described = set()
+        
+        def describe(name: str, kind: str, help_text: str):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+        
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, [value[0], list(value[1]), value[2], value[3]]) for key, value in self._histograms.items())
+        
+        for (name, labels), value in counters:
+            describe(name, *self.DESCRIPTIONS.get(name, ("counter", name)))
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+        
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            describe(name, *self.DESCRIPTIONS.get(name, ("histogram", name)))
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%g"' % bound
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{name}_bucket{self._labels(labels, le)} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        
+        for name, value in sorted((gauges or {}).items()):
+            describe(name, "gauge", name.replace("_", " "))
+            lines.append(f"{name} {value:g}")
+        
+        return "\n".join(lines) + "\n"
+
+class IntentClassifier:
+    """Local fast-path intent classifier built from the activation keyword lists.
+
+    Clear-cut messages are decided locally; only ambiguous ones (returned as
+    None) need the LLM.
+    """
+
+    # Tokens that appear in keyword phrases but carry no intent on their own
+    STOPWORDS = {"to", "on", "off", "mode"}
+    NEGATIONS = {"don't", "dont", "not", "never", "no", "can't", "cant", "won't", "wont"}
+
+    def __init__(self, keywords: Dict[str, List[str]], threshold: float = 1.0,
+                 margin: float = 0.5, max_words: int = 4):
+        self.keywords = keywords
+        self.threshold = threshold
+        self.margin = margin
+        self.max_words = max_words
+
+        # Compiled phrase matchers, longest phrase first
+        self.phrase_patterns = {
+            intent: re.compile(r"\b(?:" + "|".join(
+                re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True)
+            ) + r")\b")
+            for intent, phrases in keywords.items()
+        }
+
+        # Scoring model: each phrase spreads one point over its informative tokens
+        self.weights: Dict[str, Dict[str, float]] = {}
+        for intent, phrases in keywords.items():
+            for phrase in phrases:
+                tokens = [t for t in phrase.split() if t not in self.STOPWORDS]
+                for token in tokens:
+                    intent_weights = self.weights.setdefault(token, {})
+                    intent_weights[intent] = intent_weights.get(intent, 0.0) + 1.0 / len(tokens)
+
+        self.token_pattern = re.compile(r"[a-z0-9']+")
+
+        self._lock = threading.Lock()
+        self.local_decisions = 0
+        self.llm_calls = 0
+
+    def classify(self, message: str) -> Optional[str]:
+        """Return activate/deactivate/neither, or None if the LLM should decide"""
+        text = message.lower().strip()
+        tokens = self.token_pattern.findall(text)
+        cues = [t for t in tokens if t in self.weights]
+
+        if not cues:
+            return self._local("neither")
+
+        if len(tokens) > self.max_words or any(t in self.NEGATIONS for t in tokens):
+            return self._ambiguous()
+
+        scores = {intent: 0.0 for intent in self.keywords}
+        for token in cues:
+            for intent, weight in self.weights[token].items():
+                scores[intent] += weight
+        for intent, pattern in self.phrase_patterns.items():
+            if pattern.search(text):
+                scores[intent] += 1.0
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_intent, best = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+
+        if best >= self.threshold and best - runner_up >= self.margin:
+            return self._local(best_intent)
+        return self._ambiguous()
+
+    def keyword_intent(self, message: str) -> str:
+        """Plain substring match, used when the LLM is unavailable"""
+        message_lower = message.lower()
+        for intent, phrases in self.keywords.items():
+            if any(phrase in message_lower for phrase in phrases):
+                return intent
+        return "neither"
+
+    def _local(self, intent: str) -> str:
+        with self._lock:
+            self.local_decisions += 1
+        return intent
+
+    def _ambiguous(self) -> None:
+        with self._lock:
+            self.llm_calls += 1
+        return None
+
+    def stats(self) -> Dict:
+        """How many intent checks were answered locally vs sent to the LLM"""
+        with self._lock:
+            return {
+                "local_decisions": self.local_decisions,
+                "llm_calls": self.llm_calls,
+                "llm_calls_saved": self.local_decisions
+            }
+
+
+class UserStateCache:
+    """Bounded LRU cache of per-user state (ai_active, total_messages, games_won, last_active).
+
+    Write-through: callers write SQLite first, then apply the same change here.
+    Entries also expire after `ttl` seconds so other workers' writes show up.
+    """
+
+    def __init__(self, capacity: int = 10000, ttl: float = 30.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and (not self.ttl or time.monotonic() - entry[0] < self.ttl):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[1])
+            if entry:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user_id: str, state: Dict):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic(), dict(state))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def apply(self, user_id: str, set_fields: Optional[Dict] = None, add_fields: Optional[Dict] = None):
+        """Mirror a committed write onto the cached entry (no-op if not cached)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not entry:
+                return
+            state = entry[1]
+            state.update(set_fields or {})
+            for field, delta in (add_fields or {}).items():
+                state[field] = (state.get(field) or 0) + delta
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), close enough for prompt budgets"""
+    return (len(text) + 3) // 4
+
+
+class ContextBuilder:
+    """Packs a user's recent turns, newest first, into a prompt token budget.
+
+    The rolling summary is charged against the same budget; turns that no
+    longer fit are the summary's job.
+    """
+
+    MESSAGE_OVERHEAD = 4  # role and separators per chat message
+
+    def __init__(self, budget: int = 400, max_turns: int = 20):
+        self.budget = budget
+        self.max_turns = max_turns
+
+    def message_tokens(self, content: str) -> int:
+        return estimate_tokens(content) + self.MESSAGE_OVERHEAD
+
+    def pack(self, turns: List[Tuple[str, str]], summary: Optional[str] = None) -> List[Dict]:
+        """Chat messages for (message, response) turns given newest first, in chronological order"""
+        remaining = self.budget - (estimate_tokens(summary) if summary else 0)
+        packed = []
+        for message, response in turns[:self.max_turns]:
+            cost = self.message_tokens(message) + self.message_tokens(response)
+            if cost > remaining:
+                break
+            remaining -= cost
+            packed.append((message, response))
+        
+        history = []
+        for message, response in reversed(packed):
+            history.append({"role": "user", "content": message})
+            if response:  # coalesced messages before the one that got the reply
+                history.append({"role": "assistant", "content": response})
+        return history
+
+class ResponseCache:
+    """Lets common messages ("play a game", "roast me") skip the reply completion.
+
+    Keys are normalized message text, and there are two tiers, both LRU with
+    TTLs:
+    - routes: the function call (name, args) the LLM picked for a message after
+      a given assistant turn ("yes" after "another?" is not "yes" after a joke).
+      These are shared by all users and replayed for whoever asks, so the
+      function still runs fresh. A route is only served once the LLM has picked
+      it `min_hits` times in a row. Activation toggles are never cached.
+    - replies: free-text replies, per user. A reply is reused only while the
+      user's summary, game record and packed history are all unchanged.
+    """
+
+    UNCACHEABLE_FUNCTIONS = {"activate_alter_ego", "deactivate_alter_ego"}
+
+    def __init__(self, capacity: int = 10000, route_ttl: float = 3600.0, reply_ttl: float = 600.0,
+                 min_hits: int = 2, max_words: int = 8):
+        self.capacity = capacity
+        self.route_ttl = route_ttl
+        self.reply_ttl = reply_ttl
+        self.min_hits = min_hits
+        self.max_words = max_words
+        self._routes: "OrderedDict[str, list]" = OrderedDict()
+        self._replies: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.route_hits = 0
+        self.reply_hits = 0
+        self.misses = 0
+
+    def key(self, message: str) -> Optional[str]:
+        """Normalized text, or None for messages too long (or empty) to be worth caching"""
+        text = re.sub(r"[^\w\s]", " ", message.lower())
+        text = re.sub(r"(\w)\1{2,}", r"\1\1", text)  # "pleeease" -> "pleease"
+        words = text.split()
+        if not words or len(words) > self.max_words:
+            return None
+        return " ".join(words)
+
+    @staticmethod
+    def route_key(key: str, context: str) -> str:
+        """Route key: message text plus a digest of the assistant turn it answers"""
+        return f"{key}\0{hashlib.sha1(context.encode()).hexdigest()[:16]}"
+
+    @staticmethod
+    def _bound(entries: OrderedDict, capacity: int):
+        while len(entries) > capacity:
+            entries.popitem(last=False)
+
+    def route(self, key: str, context: str) -> Optional[Tuple[str, Dict]]:
+        """(function name, arguments) once the LLM has settled on one for this
+        message in reply to the assistant turn `context`"""
+        key = self.route_key(key, context)
+        with self._lock:
+            entry = self._routes.get(key)
+            if entry and entry[0] > time.monotonic() and entry[3] >= self.min_hits:
+                self._routes.move_to_end(key)
+                self.route_hits += 1
+                return entry[1], dict(entry[2])
+            return None
+
+    def reply(self, user_id: str, key: str, stamp: tuple) -> Optional[str]:
+        """This user's earlier reply to the same message, if their prompt context still matches"""
+        with self._lock:
+            entry = self._replies.get((user_id, key))
+            if entry and entry[0] > time.monotonic() and entry[1] == stamp:
+                self._replies.move_to_end((user_id, key))
+                self.reply_hits += 1
+                return entry[2]
+            if entry:
+                del self._replies[(user_id, key)]
+            self.misses += 1
+            return None
+
+    def remember(self, user_id: str, key: str, context: str, stamp: tuple,
+                 function_call: Optional[Tuple[str, Dict]], reply: str):
+        """Record what the LLM did with a message: the function it called, or its text reply"""
+        now = time.monotonic()
+        route_key = self.route_key(key, context)
+        with self._lock:
+            if function_call is None:
+                self._routes.pop(route_key, None)  # not consistently a function call
+                self._replies[(user_id, key)] = (now + self.reply_ttl, stamp, reply)
+                self._replies.move_to_end((user_id, key))
+                self._bound(self._replies, self.capacity)
+                return
+            
+            name, arguments = function_call
+            if name in self.UNCACHEABLE_FUNCTIONS:
+                self._routes.pop(route_key, None)
+                return
+            entry = self._routes.get(route_key)
+            hits = entry[3] + 1 if entry and entry[0] > now and entry[1:3] == [name, arguments] else 1
+            self._routes[route_key] = [now + self.route_ttl, name, dict(arguments), hits]
+            self._routes.move_to_end(route_key)
+            self._bound(self._routes, self.capacity)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "routes": len(self._routes),
+                "replies": len(self._replies),
+                "route_hits": self.route_hits,
+                "reply_hits": self.reply_hits,
+                "misses": self.misses
+            }
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        if os.getenv("RESPONSE_CACHE", "1") != "1":
+            return None
+        return cls(
+            capacity=int(os.getenv("RESPONSE_CACHE_SIZE", 10000)),
+            route_ttl=float(os.getenv("ROUTE_CACHE_TTL_S", 3600)),
+            reply_ttl=float(os.getenv("REPLY_CACHE_TTL_S", 600)),
+            min_hits=int(os.getenv("ROUTE_CACHE_MIN_HITS", 2)),
+            max_words=int(os.getenv("RESPONSE_CACHE_MAX_WORDS", 8))
+        )
+
+class RequestDeduplicator:
+    """Collapses webhook retries onto the first delivery of a message.
+
+    Keyed on the client's message id when there is one, otherwise on
+    (user_id, message) within a `window`-second bucket (the previous bucket
+    is checked too, so a retry straddling a boundary still matches). Retries
+    of a running request share its Future; finished results are kept for
+    `ttl` seconds. Failures are not cached, so a retry after an error runs again.
+    """
+
+    def __init__(self, ttl: float = 60.0, window: float = 15.0, capacity: int = 10000):
+        self.ttl = ttl
+        self.window = window
+        self.capacity = capacity
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.in_flight_hits = 0
+        self.completed_hits = 0
+
+    def keys(self, user_id: str, message: str, message_id: Optional[str] = None) -> List[str]:
+        if message_id:
+            return [f"id:{user_id}:{message_id}"]
+        digest = hashlib.sha1(f"{user_id}\0{message.strip()}".encode()).hexdigest()
+        bucket = int(time.time() // self.window)
+        return [f"msg:{digest}:{bucket}", f"msg:{digest}:{bucket - 1}"]
+
+    def claim(self, user_id: str, message: str, message_id: Optional[str] = None) -> Tuple[Future, bool]:
+        """(future, True) for a first delivery, which must resolve the future;
+        (existing future, False) for a duplicate"""
+        keys = self.keys(user_id, message, message_id)
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    if entry[1].done():
+                        self.completed_hits += 1
+                    else:
+                        self.in_flight_hits += 1
+                    return entry[1], False
+            
+            future = Future()
+            self._entries[keys[0]] = [float("inf"), future]
+            self._entries.move_to_end(keys[0])
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[0] > now and len(self._entries) <= self.capacity:
+                    break
+                self._entries.popitem(last=False)
+        
+        future.add_done_callback(lambda done: self._finish(keys[0], done))
+        return future, True
+
+    def _finish(self, key: str, future: Future):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry[1] is not future:
+                return
+            if future.exception() is not None:
+                del self._entries[key]
+            else:
+                entry[0] = time.monotonic() + self.ttl
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight_hits": self.in_flight_hits,
+                "completed_hits": self.completed_hits
+            }
+
+    @classmethod
+    def from_env(cls) -> Optional["RequestDeduplicator"]:
+        if os.getenv("DEDUP", "1") != "1":
+            return None
+        return cls(
+            ttl=float(os.getenv("DEDUP_TTL_S", 60)),
+            window=float(os.getenv("DEDUP_WINDOW_S", 15)),
+            capacity=int(os.getenv("DEDUP_MAX_ENTRIES", 10000))
+        )
+
+class UserMailboxes:
+    """Per-user ordered processing: one batch of a user's messages runs at a time.
+
+    The request at the head of a user's queue leads: it waits `window` seconds
+    for the rest of a burst, hands up to `max_batch` queued messages to
+    `process(user_id, messages) -> replies`, then passes the lead to the next
+    waiting request. With no window nothing is coalesced: each message is
+    processed on its own, in order, after the previous one has finished.
+    """
+
+    def __init__(self, window: float = 0.0, max_batch: int = 10):
+        self.window = window
+        self.max_batch = max_batch
+        self._boxes: Dict[str, List] = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.messages = 0
+
+    def _enqueue(self, user_id: str, entry) -> List:
+        with self._lock:
+            box = self._boxes.setdefault(user_id, [])
+            box.append(entry)
+            if len(box) == 1:
+                entry.turn.set()  # nobody is leading this user
+            return box
+
+    def _take(self, box: List) -> List:
+        with self._lock:
+            return box[:self.max_batch if self.window else 1]
+
+    def _release(self, user_id: str, box: List, batch: List, replies=None, error: Optional[Exception] = None):
+        for i, entry in enumerate(batch):
+            if error is not None:
+                entry.future.set_exception(error)
+            else:
+                entry.future.set_result(replies[i])
+        with self._lock:
+            del box[:len(batch)]
+            self.batches += 1
+            self.messages += len(batch)
+            if box:
+                box[0].turn.set()  # hand the lead to the next waiting request
+            else:
+                del self._boxes[user_id]
+        for entry in batch[1:]:
+            entry.turn.set()
+
+    def submit(self, user_id: str, message: str, process) -> str:
+        entry = SimpleNamespace(message=message, future=Future(), turn=threading.Event())
+        box = self._enqueue(user_id, entry)
+        entry.turn.wait()
+        if not entry.future.done():
+            if self.window:
+                time.sleep(self.window)  # let the rest of a burst arrive
+            batch = self._take(box)
+            try:
+                replies = process(user_id, [queued.message for queued in batch])
+            except Exception as e:
+                self._release(user_id, box, batch, error=e)
+            else:
+                self._release(user_id, box, batch, replies)
+        return entry.future.result()
+
+    async def submit_async(self, user_id: str, message: str, process) -> str:
+        """submit() for the event loop; `process` is a coroutine function"""
+        loop = asyncio.get_running_loop()
+        turn = asyncio.Event()
+        entry = SimpleNamespace(message=message, future=Future(),
+                                turn=SimpleNamespace(set=lambda: loop.call_soon_threadsafe(turn.set)))
+        box = self._enqueue(user_id, entry)
+        await turn.wait()
+        if not entry.future.done():
+            if self.window:
+                await asyncio.sleep(self.window)
+            batch = self._take(box)
+            try:
+                replies = await process(user_id, [queued.message for queued in batch])
+            except Exception as e:
+                self._release(user_id, box, batch, error=e)
+            else:
+                self._release(user_id, box, batch, replies)
+        return entry.future.result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "window_ms": self.window * 1000,
+                "busy_users": len(self._boxes),
+                "batches": self.batches,
+                "messages": self.messages
+            }
+
+    @classmethod
+    def from_env(cls) -> Optional["UserMailboxes"]:
+        if os.getenv("USER_SERIALIZE", "1") != "1":
+            return None
+        return cls(
+            window=float(os.getenv("COALESCE_WINDOW_MS", 0)) / 1000,
+            max_batch=int(os.getenv("COALESCE_MAX_MESSAGES", 10))
+        )
+
+class LLMUnavailable(Exception):
+    """The LLM was skipped: circuit open or no time left in the request budget"""
+
+# The current request's Deadline, if the route set one
+_request_deadline: ContextVar[Optional["Deadline"]] = ContextVar("request_deadline", default=None)
+
+class Deadline:
+    """Time budget for one request, shared out across its LLM stages"""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive LLM failures.
+
+    While open every call is refused immediately; a background thread runs
+    `probe` every `cooldown` seconds and closes the breaker once it succeeds.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 15.0, probe=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self.trips = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            # Without a probe, let one trial call through per cooldown (half-open)
+            if self.probe is None and time.monotonic() - self._opened_at >= self.cooldown:
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._opened_at is not None:
+                print("✅ LLM circuit closed")
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None or self._failures < self.threshold:
+                return
+            self._opened_at = time.monotonic()
+            self.trips += 1
+        print(f"⚡ LLM circuit open after {self.threshold} failures, serving fallbacks")
+        if self.probe is not None:
+            threading.Thread(target=self._probe_until_closed, name="llm-probe", daemon=True).start()
+
+    def _probe_until_closed(self):
+        while self.is_open:
+            time.sleep(self.cooldown)
+            try:
+                self.probe()
+            except Exception as e:
+                print(f"LLM probe failed: {e}")
+                continue
+            self.record_success()
+
+class LLMBackend(ABC):
+    """Chat-completion provider behind every LLM call.
+
+    complete()/acomplete() take OpenAI chat.completions.create arguments and
+    return an OpenAI-shaped response (choices[0].message, usage).
+    """
+
+    @abstractmethod
+    def complete(self, **request):
+        ...
+
+    @abstractmethod
+    async def acomplete(self, **request):
+        ...
+
+    def warmup(self):
+        """Open connections ahead of the first request (no-op by default)"""
+
+    async def awarmup(self):
+        pass
+
+    @staticmethod
+    def from_env() -> "LLMBackend":
+        backend = os.getenv("LLM_BACKEND", "azure").lower()
+        if backend == "stub":
+            return StubBackend(
+                latency=os.getenv("STUB_LATENCY", "lognormal:400:0.4"),
+                function_rate=float(os.getenv("STUB_FUNCTION_RATE", 0.2))
+            )
+        return AzureBackend()
+
+class AzureBackend(LLMBackend):
+    """Azure OpenAI (async client serves the ASGI pipeline)"""
 
-class HarshaMemoryAPI:
     def __init__(self):
         # Check required environment variables
         required_env_vars = ["AZURE_OPENAI_API_KEY", "AZURE_ENDPOINT"]
@@ -27,18 +2117,220 @@ class HarshaMemoryAPI:
         if missing_vars:
             raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
         
-        # Azure OpenAI
-        self.ai_client = AzureOpenAI(
-            api_version=os.getenv("AZURE_API_VERSION", "2024-12-01-preview"),
-            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY")
+        azure_config = {
+            "api_version": os.getenv("AZURE_API_VERSION", "2024-12-01-preview"),
+            "azure_endpoint": os.getenv("AZURE_ENDPOINT"),
+            "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+            # Per-request deadlines and the circuit breaker replace blind retries
+            "max_retries": int(os.getenv("AZURE_MAX_RETRIES", 0))
+        }
+        self.endpoint = azure_config["azure_endpoint"]
+        
+        # Explicit keep-alive pools, shared by every request in this process
+        self.http_client = httpx.Client(**self.http_config())
+        self.async_http_client = httpx.AsyncClient(**self.http_config())
+        self.client = AzureOpenAI(http_client=self.http_client, **azure_config)
+        self.async_client = AsyncAzureOpenAI(http_client=self.async_http_client, **azure_config)
+
+    @staticmethod
+    def http_config() -> Dict:
+        """httpx client settings: pool limits, keep-alive and optional HTTP/2 (needs h2)"""
+        http2 = os.getenv("AZURE_HTTP2", "0") == "1"
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print("⚠️ AZURE_HTTP2=1 needs the h2 package, using HTTP/1.1")
+                http2 = False
+        return {
+            "http2": http2,
+            "limits": httpx.Limits(
+                max_connections=int(os.getenv("AZURE_MAX_CONNECTIONS", 32)),
+                max_keepalive_connections=int(os.getenv("AZURE_MAX_KEEPALIVE", 16)),
+                keepalive_expiry=float(os.getenv("AZURE_KEEPALIVE_S", 60))
+            ),
+            "timeout": httpx.Timeout(30.0, connect=5.0)
+        }
+
+    def warmup(self):
+        # Any response will do: the point is a pooled connection with TLS already done
+        try:
+            self.http_client.head(self.endpoint, timeout=5)
+        except Exception as e:
+            print(f"⚠️ LLM warmup failed: {e}")
+
+    async def awarmup(self):
+        try:
+            await self.async_http_client.head(self.endpoint, timeout=5)
+        except Exception as e:
+            print(f"⚠️ LLM warmup failed: {e}")
+
+    def complete(self, **request):
+        return self.client.chat.completions.create(**request)
+
+    async def acomplete(self, **request):
+        return await self.async_client.chat.completions.create(**request)
+
+class StubBackend(LLMBackend):
+    """Offline stand-in for benchmarks and local runs: no network, no tokens.
+
+    latency is "fixed:MS", "uniform:LO_MS:HI_MS" or "lognormal:MEDIAN_MS:SIGMA".
+    Replies route obvious requests to the matching function call, otherwise
+    pick a random offered function `function_rate` of the time, else canned text.
+    """
+
+    ROUTES = [
+        (re.compile(r"\b(emoji|movie|game|play)\b"), "start_emoji_game"),
+        (re.compile(r"\b(math|maths|numbers?)\b"), "start_math_game"),
+        (re.compile(r"\broast\b"), "roast_user"),
+        (re.compile(r"\b(hype|motivate|sad)\b"), "hype_user"),
+        (re.compile(r"\b(remember|recall)\b"), "recall_memory"),
+        (re.compile(r"\b(bye alter|turn off|stop)\b"), "deactivate_alter_ego"),
+    ]
+    REPLIES = ["bet 🔥", "no cap that's wild", "lowkey iconic fr", "say less 👀", "main character moment"]
+
+    def __init__(self, latency: str = "lognormal:400:0.4", function_rate: float = 0.2, seed: Optional[int] = None):
+        self.latency = latency
+        self.function_rate = function_rate
+        self.random = random.Random(seed)
+        kind, *params = latency.split(":")
+        self._latency_kind = kind
+        self._latency_params = [float(param) for param in params]
+
+    def sample_latency(self) -> float:
+        """Seconds to wait before answering"""
+        params = self._latency_params
+        if self._latency_kind == "fixed":
+            ms = params[0]
+        elif self._latency_kind == "uniform":
+            ms = self.random.uniform(params[0], params[1])
+        elif self._latency_kind == "lognormal":
+            ms = params[0] * self.random.lognormvariate(0, params[1])
+        else:
+            raise ValueError(f"Unknown stub latency distribution: {self.latency}")
+        return ms / 1000
+
+    def respond(self, request: Dict):
+        prompt = " ".join(str(message.get("content") or "") for message in request["messages"])
+        
+        if not request.get("functions"):
+            # Prompts without functions, e.g. intent classification
+            quoted = re.search(r'Message: "(.*)"', prompt)
+            text = (quoted.group(1) if quoted else prompt).lower()
+            if re.search(r"\b(talk to alter|activate|turn on)\b", text):
+                return self._response("activate", prompt=prompt)
+            if re.search(r"\b(bye alter|deactivate|turn off|stop)\b", text):
+                return self._response("deactivate", prompt=prompt)
+            return self._response("neither" if quoted else self.random.choice(self.REPLIES), prompt=prompt)
+        
+        offered = [function["name"] for function in request["functions"]]
+        last_message = (request["messages"][-1].get("content") or "").lower()
+        for pattern, name in self.ROUTES:
+            if name in offered and pattern.search(last_message):
+                return self._function_call(name, last_message, prompt)
+        if self.random.random() < self.function_rate:
+            return self._function_call(self.random.choice(offered), last_message, prompt)
+        return self._response(self.random.choice(self.REPLIES), prompt=prompt)
+
+    def _function_call(self, name: str, message: str, prompt: str):
+        arguments = {}
+        if name == "recall_memory":
+            words = re.findall(r"[a-z0-9]+", message)
+            arguments["topic"] = words[-1] if words else "stuff"
+        call = SimpleNamespace(name=name, arguments=json.dumps(arguments))
+        return self._response(None, function_call=call, prompt=prompt)
+
+    def _response(self, content: Optional[str], function_call=None, prompt: str = ""):
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(content or "") // 4)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content, function_call=function_call))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=prompt_tokens + completion_tokens)
+        )
+
+    def complete(self, timeout: Optional[float] = None, **request):
+        latency = self.sample_latency()
+        time.sleep(min(latency, timeout or latency))
+        if timeout is not None and latency > timeout:
+            raise TimeoutError("stub completion timed out")
+        return self.respond(request)
+
+    async def acomplete(self, timeout: Optional[float] = None, **request):
+        latency = self.sample_latency()
+        await asyncio.sleep(min(latency, timeout or latency))
+        if timeout is not None and latency > timeout:
+            raise TimeoutError("stub completion timed out")
+        return self.respond(request)
+
+class HarshaMemoryAPI:
+    def __init__(self):
+        # LLM provider: Azure OpenAI, or the offline stub (LLM_BACKEND=stub)
+        self.llm = LLMBackend.from_env()
+        
+        # Stage timers and path counters for /metrics
+        self.metrics = Metrics(slow_request_ms=float(os.getenv("SLOW_REQUEST_MS", 0)))
+        
+        # Request deadline (ManyChat gives up after ~10s), split across LLM stages as
+        # (share of remaining time, cap in seconds)
+        self.request_deadline_s = float(os.getenv("REQUEST_DEADLINE_S", 8))
+        self.stage_budgets = {
+            "llm_intent": (0.4, float(os.getenv("LLM_INTENT_TIMEOUT_S", 2))),
+            "llm_reply": (1.0, float(os.getenv("LLM_REPLY_TIMEOUT_S", 6))),
+            "llm_summary": (1.0, 10.0)  # background only, never inside a request
+        }
+        self.min_llm_budget_s = 0.25
+        self.breaker = CircuitBreaker(
+            threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", 5)),
+            cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN_S", 15)),
+            probe=self.probe_llm
         )
         
         # Initialize database
         self.init_database()
         
-        # In-memory cache for active games
-        self.game_states = {}
+        # Reply context: recent turns packed to a token budget, older turns folded into
+        # a per-user summary that is refreshed in the background every N saved turns
+        self.context = ContextBuilder(
+            budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", 400)),
+            max_turns=int(os.getenv("CONTEXT_MAX_TURNS", 20))
+        )
+        self.summary_every = int(os.getenv("SUMMARY_EVERY_N_TURNS", 10))
+        self.summary_keep_turns = 4  # newest turns are left to the packed history
+        self.summary_batch = 50
+        self._summarizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+        self._summarizing = set()
+        self._summarizing_lock = threading.Lock()
+        atexit.register(self._summarizer.shutdown, wait=False, cancel_futures=True)
+        
+        # ManyChat retries slow webhooks; duplicates share the first delivery's reply
+        self.dedup = RequestDeduplicator.from_env()
+        
+        # Settled function routes (all users) and free-text replies (per user) skip the LLM
+        self.response_cache = ResponseCache.from_env()
+        
+        # One batch of a user's messages at a time; bursts get a single AI reply
+        self.mailboxes = UserMailboxes.from_env()
+        
+        # Per-user state cache in front of user_stats
+        self.user_cache = UserStateCache(
+            capacity=int(os.getenv("USER_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("USER_CACHE_TTL", 30))
+        )
+        
+        # Active games, in memory or shared through SQLite (GAME_STATE_BACKEND)
+        self.game_states = GameStateStore.from_env(self.store)
+        
+        # Activation keywords, used by the local intent classifier and as LLM fallback
+        self.intent_keywords = {
+            "activate": ["talk to alter", "activate", "turn on", "start ai", "bot mode"],
+            "deactivate": ["bye alter", "deactivate", "turn off", "stop", "disable"]
+        }
+        self.intent_classifier = IntentClassifier(self.intent_keywords)
+        
+        # "separate": dedicated intent call before the reply
+        # "merged": active users get intent as function calls in the main completion
+        self.intent_mode = os.getenv("INTENT_MODE", "separate").lower()
         
         # Function definitions for AI
         self.functions = [
@@ -75,6 +2367,23 @@ class HarshaMemoryAPI:
             }
         ]
         
+        # Intent functions, only offered to the model in merged mode
+        self.intent_functions = [
+            {
+                "name": "activate_alter_ego",
+                "description": "User wants to start chatting with the bot",
+                "parameters": {"type": "object", "properties": {}, "required": []}
+            },
+            {
+                "name": "deactivate_alter_ego",
+                "description": "User wants to stop chatting with the bot (e.g. 'bye alter', 'stop', 'turn off')",
+                "parameters": {"type": "object", "properties": {}, "required": []}
+            }
+        ]
+        
+        self.activation_reply = "🤖 Alter ego activated! Ready to chat with chaotic energy! What's good?"
+        self.deactivation_reply = "✌️ Alter ego deactivated. Peace out! Say something like 'talk to alter' to reactivate."
+        
         # Quick responses
         self.quick_replies = {
             "sup": ["yo! 👊", "what's good? 🔥"], 
@@ -106,118 +2415,254 @@ class HarshaMemoryAPI:
         print("🔥 Memory API loaded!")
     
     def init_database(self):
-        """Initialize SQLite database"""
-        self.conn = sqlite3.connect('harsha_memory.db', check_same_thread=False)
-        
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                message TEXT NOT NULL,
-                response TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        """Initialize SQLite database (one file per shard, HARSHA_SHARDS)"""
+        self.store = ShardedStore.from_env(DB_PATH)
         
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_stats (
-                user_id TEXT PRIMARY KEY,
-                total_messages INTEGER DEFAULT 0,
-                games_won INTEGER DEFAULT 0,
-                ai_active BOOLEAN DEFAULT FALSE,
-                last_active DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        version = self.store.migrate(rollups=os.getenv("STATS_ROLLUPS", "0") == "1")
+        with self.store.pools[0].read() as cursor:
+            self.fts_enabled = fts_enabled(cursor.connection)
+            for problem in check_query_plans(cursor.connection):
+                print(f"⚠️ Query plan regression: {problem}")
         
-        # Add ai_active column if it doesn't exist (for existing databases)
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute("ALTER TABLE user_stats ADD COLUMN ai_active BOOLEAN DEFAULT FALSE")
-            self.conn.commit()
-            print("Added ai_active column to existing database")
-        except:
-            pass  # Column already exists
+        # Cold tier: old turns are compacted into compressed blocks in the background
+        self.archive = ConversationArchive.from_env(self.store)
+        self.archive.start()
+        atexit.register(self.archive.close)
+        
+        # Semantic memory index, fed off the write path after each commit
+        self.vectors = VectorIndex.from_env(DB_PATH)
+        self._indexer = None
+        if self.vectors:
+            self._indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="indexer")
+            atexit.register(self._indexer.shutdown)
         
-        self.conn.commit()
-        print("📚 Database ready!")
+        # Conversation logging happens behind the reply; flush it on shutdown
+        self.writer = ShardedWriter(self.store, on_commit=self.index_conversations if self.vectors else None)
+        atexit.register(self.writer.close)
+        
+        print(f"📚 Database ready! (schema v{version}, {len(self.store)} shard{'s' if len(self.store) > 1 else ''})")
     
     def save_conversation(self, user_id: str, message: str, response: str):
-        """Save to database"""
+        """Save to database (group-committed by the writer)"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "INSERT INTO conversations (user_id, message, response) VALUES (?, ?, ?)",
-                (user_id, message, response)
-            )
-            
-            # Update stats (preserve ai_active status)
-            cursor.execute(
-                "INSERT OR REPLACE INTO user_stats (user_id, last_active, total_messages, ai_active, games_won) VALUES (?, ?, COALESCE((SELECT total_messages FROM user_stats WHERE user_id = ?) + 1, 1), COALESCE((SELECT ai_active FROM user_stats WHERE user_id = ?), 0), COALESCE((SELECT games_won FROM user_stats WHERE user_id = ?), 0))",
-                (user_id, datetime.now().isoformat(), user_id, user_id, user_id)
-            )
-            
-            self.conn.commit()
+            now = datetime.now().isoformat()
+            self.writer.save_conversation(user_id, message, response, now)
+            self.user_cache.apply(user_id, {"last_active": now}, {"total_messages": 1})
+            self.maybe_refresh_summary(user_id)
         except Exception as e:
             print(f"Save error: {e}")
     
+    def recent_turns(self, user_id: str, limit: int = 10) -> List[Tuple[str, str]]:
+        """(message, response) turns newest first, including ones still waiting to be written"""
+        def read():
+            with self.store.read(user_id) as cursor:
+                cursor.execute(HISTORY_QUERY, (user_id, limit))
+                return cursor.fetchall()
+        
+        rows, pending = self.writer.read_your_writes(user_id, read)
+        unflushed = [(op["message"], op["response"]) for op in pending if op["kind"] == "conversation"]
+        return (unflushed[::-1] + [tuple(row) for row in rows])[:limit]
+    
     def get_conversation_history(self, user_id: str, limit: int = 10) -> List[Dict]:
-        """Get recent conversations"""
+        """Get recent conversations, including ones still waiting to be written"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT message, response FROM conversations WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-                (user_id, limit)
-            )
-            
-            rows = cursor.fetchall()
             history = []
-            
-            for row in reversed(rows):
-                history.extend([
-                    {"role": "user", "content": row[0]},
-                    {"role": "assistant", "content": row[1]}
-                ])
+            for message, response in reversed(self.recent_turns(user_id, limit)):
+                history.append({"role": "user", "content": message})
+                if response:
+                    history.append({"role": "assistant", "content": response})
             
             return history
         except Exception as e:
             print(f"Read error: {e}")
             return []
     
+    def get_summary(self, user_id: str) -> Optional[str]:
+        """Rolling summary of this user's older turns, if one has been written"""
+        try:
+            with self.store.read(user_id) as cursor:
+                cursor.execute(SUMMARY_QUERY, (user_id,))
+                row = cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Summary read error: {e}")
+            return None
+    
+    def build_context(self, user_id: str) -> Tuple[List[Dict], Optional[str]]:
+        """Reply context: (recent history packed to the token budget, summary of older turns)"""
+        try:
+            summary = self.get_summary(user_id)
+            return self.context.pack(self.recent_turns(user_id, self.context.max_turns), summary), summary
+        except Exception as e:
+            print(f"Read error: {e}")
+            return [], None
+    
+    def maybe_refresh_summary(self, user_id: str):
+        """Queue a background summary refresh every `summary_every` saved turns"""
+        if self.summary_every <= 0:
+            return
+        total = self.get_user_state(user_id)["total_messages"]
+        if total <= self.summary_keep_turns or total % self.summary_every:
+            return
+        with self._summarizing_lock:
+            if user_id in self._summarizing:
+                return
+            self._summarizing.add(user_id)
+        try:
+            self._summarizer.submit(self.refresh_summary, user_id)
+        except RuntimeError:
+            # Shutting down; the next refresh will catch up
+            with self._summarizing_lock:
+                self._summarizing.discard(user_id)
+    
+    def summary_request(self, summary: Optional[str], turns: List[Tuple]) -> Dict:
+        """Completion arguments that fold new turns into the running summary"""
+        transcript = "\n".join(f"User: {message}\nYou: {response}" for _, message, response in turns)
+        prompt = f"""Update your running memory of a chat with this user.
+            Keep names, preferences, running jokes and anything they asked you to remember.
+            Reply with the updated memory only, under 80 words.
+            
+            Current memory: {summary or "(nothing yet)"}
+            
+            New turns:
+            {transcript}"""
+        
+        return {
+            "model": os.getenv("AZURE_DEPLOYMENT", "gpt-5-chat"),
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": 120,
+            "temperature": 0.3
+        }
+    
+    def refresh_summary(self, user_id: str):
+        """Fold the oldest unsummarized turns (up to `summary_batch`, never the newest
+        `summary_keep_turns`) into the user's summary; repeated runs catch up"""
+        try:
+            with self.store.read(user_id) as cursor:
+                cursor.execute(SUMMARY_QUERY, (user_id,))
+                summary, through = cursor.fetchone() or (None, 0)
+                cursor.execute(UNSUMMARIZED_QUERY, (user_id, through, user_id, self.summary_keep_turns - 1,
+                                                    self.summary_batch))
+                turns = cursor.fetchall()
+            if not turns:
+                return
+            
+            response = self.complete("llm_summary", self.summary_request(summary, turns))
+            updated = (response.choices[0].message.content or "").strip()
+            if not updated:
+                return
+            
+            with self.store.write(user_id) as cursor:
+                cursor.execute(SUMMARY_UPSERT, (user_id, updated, turns[-1][0], datetime.now().isoformat()))
+            self.metrics.inc("harsha_summaries_total")
+        except Exception as e:
+            print(f"Summary error: {e}")
+        finally:
+            with self._summarizing_lock:
+                self._summarizing.discard(user_id)
+    
+    def get_history_page(self, user_id: str, limit: int = 10, cursor: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+        """One page of committed turns older than `cursor` (newest first) and the cursor for the next page"""
+        limit = max(1, min(limit, MEMORY_PAGE_MAX))
+        with self.store.read(user_id) as db_cursor:
+            db_cursor.execute(HISTORY_PAGE_QUERY, (user_id, cursor or NO_CURSOR, limit))
+            rows = [
+                {"id": row[0], "message": row[1], "response": row[2], "timestamp": row[3]}
+                for row in db_cursor.fetchall()
+            ]
+        if len(rows) < limit:
+            # Older history continues in the archive
+            before = rows[-1]["id"] if rows else cursor
+            rows += itertools.islice(self.archive.turns(user_id, before), limit - len(rows))
+        next_cursor = rows[-1]["id"] if len(rows) == limit else None
+        return rows, next_cursor
+    
+    def iter_conversations(self, user_id: str, cursor: Optional[int] = None) -> Iterator[Dict]:
+        """Stream every committed turn older than `cursor`, newest first, a batch at a time"""
+        while True:
+            with self.store.read(user_id) as db_cursor:
+                db_cursor.execute(HISTORY_PAGE_QUERY, (user_id, cursor or NO_CURSOR, EXPORT_BATCH_SIZE))
+                rows = db_cursor.fetchall()
+            # The connection goes back to the pool before the rows reach a (possibly slow) client
+            for row in rows:
+                yield {"id": row[0], "message": row[1], "response": row[2], "timestamp": row[3]}
+            if rows:
+                cursor = rows[-1][0]
+            if len(rows) < EXPORT_BATCH_SIZE:
+                yield from self.archive.turns(user_id, cursor)
+                return
+    
+    def get_user_state(self, user_id: str) -> Dict:
+        """Get cached per-user state, loading it from user_stats on a miss"""
+        state = self.user_cache.get(user_id)
+        if state is not None:
+            return state
+        
+        def read():
+            with self.store.read(user_id) as cursor:
+                cursor.execute(USER_STATE_QUERY, (user_id,))
+                return cursor.fetchone()
+        
+        row, pending = self.writer.read_your_writes(user_id, read)
+        state = self.user_state(row, pending)
+        self.user_cache.put(user_id, state)
+        return state
+    
+    @staticmethod
+    def user_state(row: Optional[tuple], pending: List[Dict]) -> Dict:
+        """State from a user_stats row plus the user's queued-but-uncommitted increments"""
+        if row:
+            state = {"total_messages": row[0] or 0, "games_won": row[1] or 0, "ai_active": bool(row[2]), "last_active": row[3]}
+        else:
+            state = {"total_messages": 0, "games_won": 0, "ai_active": False, "last_active": None}
+        
+        for op in pending:
+            if op["kind"] == "conversation":
+                state["total_messages"] += 1
+                state["last_active"] = op["timestamp"]
+            elif op["kind"] == "game_win" and row:
+                state["games_won"] += 1
+        return state
+    
+    def prefetch_user_states(self, user_ids: List[str], chunk_size: int = 500):
+        """Load uncached users into the state cache with one IN query per chunk of a shard's users"""
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if self.user_cache.get(user_id) is None]
+        chunks = [
+            shard_users[start:start + chunk_size]
+            for shard_users in self.store.group(missing).values()
+            for start in range(0, len(shard_users), chunk_size)
+        ]
+        for chunk in chunks:
+            
+            def read():
+                with self.store.read(chunk[0]) as cursor:
+                    cursor.execute(USER_STATES_QUERY.format(", ".join("?" * len(chunk))), chunk)
+                    return {row[0]: row[1:] for row in cursor.fetchall()}
+            
+            rows, pending = self.writer.read_your_writes_many(chunk, read)
+            for user_id in chunk:
+                self.user_cache.put(user_id, self.user_state(rows.get(user_id), pending.get(user_id, [])))
+    
     def get_user_stats(self, user_id: str) -> Dict:
         """Get user stats"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT total_messages, games_won, ai_active FROM user_stats WHERE user_id = ?", (user_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                return {"total_messages": row[0] or 0, "games_won": row[1] or 0, "ai_active": bool(row[2])}
-            return {"total_messages": 0, "games_won": 0, "ai_active": False}
+            state = self.get_user_state(user_id)
+            return {"total_messages": state["total_messages"], "games_won": state["games_won"], "ai_active": state["ai_active"]}
         except:
             return {"total_messages": 0, "games_won": 0, "ai_active": False}
     
     def set_ai_active(self, user_id: str, active: bool):
         """Set AI active status for user"""
         try:
-            cursor = self.conn.cursor()
-            # First check if user exists
-            cursor.execute("SELECT user_id FROM user_stats WHERE user_id = ?", (user_id,))
-            exists = cursor.fetchone()
-            
-            if exists:
-                # Update existing user
-                cursor.execute(
-                    "UPDATE user_stats SET ai_active = ?, last_active = ? WHERE user_id = ?",
-                    (active, datetime.now().isoformat(), user_id)
-                )
-            else:
-                # Insert new user
+            now = datetime.now().isoformat()
+            with self.store.write(user_id) as cursor:
                 cursor.execute(
-                    "INSERT INTO user_stats (user_id, ai_active, last_active, total_messages, games_won) VALUES (?, ?, ?, 0, 0)",
-                    (user_id, active, datetime.now().isoformat())
+                    "INSERT INTO user_stats (user_id, ai_active, last_active, total_messages, games_won) VALUES (?, ?, ?, 0, 0) "
+                    "ON CONFLICT(user_id) DO UPDATE SET ai_active = excluded.ai_active, last_active = excluded.last_active",
+                    (user_id, active, now)
                 )
             
-            self.conn.commit()
+            self.user_cache.apply(user_id, {"ai_active": active, "last_active": now})
             print(f"Set AI active for {user_id}: {active}")
         except Exception as e:
             print(f"Error setting AI active: {e}")
@@ -227,26 +2672,82 @@ class HarshaMemoryAPI:
         stats = self.get_user_stats(user_id)
         return stats.get("ai_active", False)
     
-    def search_memory(self, user_id: str, topic: str) -> str:
-        """Search previous conversations"""
+    def fts_match_query(self, user_id: str, topic: str) -> Optional[str]:
+        """Build an FTS5 MATCH expression scoped to the user's rows, or None if untokenizable"""
+        user_tokens = re.findall(r"[^\W_]+", user_id.lower())
+        topic_tokens = re.findall(r"[^\W_]+", topic.lower())
+        if not user_tokens or not topic_tokens:
+            return None
+        terms = " OR ".join(f'"{token}"*' for token in topic_tokens)
+        return f'user_id : "{" ".join(user_tokens)}" AND {{message response}} : ({terms})'
+    
+    def search_memory(self, user_id: str, topic: str, limit: int = 2) -> str:
+        """Search previous conversations, best BM25 matches first"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT message, response FROM conversations WHERE user_id = ? AND (message LIKE ? OR response LIKE ?) ORDER BY timestamp DESC LIMIT 2",
-                (user_id, f"%{topic}%", f"%{topic}%")
-            )
+            match_query = self.fts_match_query(user_id, topic) if self.fts_enabled else None
             
-            rows = cursor.fetchall()
-            if rows:
-                return f"I remember we talked about {topic}! " + " | ".join([f"You said: {row[0]}" for row in rows[:1]])
+            if match_query:
+                with self.store.read(user_id) as cursor:
+                    cursor.execute(FTS_SEARCH_QUERY, (match_query, user_id, limit))
+                    rows = cursor.fetchall()
+                # Prefer the message snippet; fall back to the response when only it matched
+                snippets = [
+                    (message if "\x02" in message or "\x02" not in response else response).replace("\x02", "").replace("\x03", "")
+                    for message, response in rows
+                ]
+                if snippets:
+                    return f"I remember we talked about {topic}! " + " | ".join(snippets)
+            else:
+                with self.store.read(user_id) as cursor:
+                    cursor.execute(MEMORY_SEARCH_QUERY, (user_id, f"%{topic}%", f"%{topic}%"))
+                    rows = cursor.fetchall()
+                if rows:
+                    return f"I remember we talked about {topic}! " + " | ".join([f"You said: {row[0]}" for row in rows[:1]])
+            
+            archived = self.archive.search(user_id, topic, limit)
+            if archived:
+                return f"I remember we talked about {topic}! " + " | ".join(archived)
             return f"hmm don't think we've talked about {topic} before"
         except:
             return "my memory's being weird rn"
     
-    def detect_intent(self, message: str) -> str:
-        """Use LLM to detect activation/deactivation intent"""
+    def index_conversations(self, rows: List[Tuple]):
+        """Writer on_commit hook: embed new rows on the indexer thread"""
+        def index():
+            try:
+                self.vectors.add([(conversation_id, user_id, f"{message}\n{response}")
+                                  for conversation_id, user_id, message, response in rows])
+            except Exception as e:
+                print(f"Index error: {e}")
+        
+        try:
+            self._indexer.submit(index)
+        except RuntimeError:
+            index()  # Interpreter shutdown stops executors before the writer's final flush
+    
+    def semantic_recall(self, user_id: str, topic: str, limit: int = 2) -> Optional[str]:
+        """Nearest past messages by embedding similarity; None when nothing is close enough"""
         try:
-            intent_prompt = f"""
+            hits = self.vectors.search(user_id, self.vectors.embedder.embed([topic]), limit)[0]
+            if not hits:
+                return None
+            ids = [conversation_id for conversation_id, _ in hits]
+            with self.store.read(user_id) as cursor:
+                cursor.execute(f"SELECT id, message FROM conversations WHERE id IN ({', '.join('?' * len(ids))})", ids)
+                messages = dict(cursor.fetchall())
+            missing = [conversation_id for conversation_id in ids if conversation_id not in messages]
+            if missing:
+                messages.update(self.archive.lookup(user_id, missing))
+            snippets = [messages[conversation_id] for conversation_id in ids if conversation_id in messages]
+            if snippets:
+                return f"I remember we talked about {topic}! " + " | ".join(snippets)
+        except Exception as e:
+            print(f"Semantic recall error: {e}")
+        return None
+    
+    def intent_request(self, message: str) -> Dict:
+        """Completion arguments for LLM intent classification"""
+        intent_prompt = f"""
             Classify this user message into one of three categories:
             1. User wants to start chatting with a bot
             2. User wants to stop chatting with a bot  
@@ -266,37 +2767,114 @@ class HarshaMemoryAPI:
 
             Reply with only: activate, deactivate, or neither
             """
-            
-            response = self.ai_client.chat.completions.create(
-                model=os.getenv("AZURE_DEPLOYMENT", "gpt-5-chat"),
-                messages=[{"role": "user", "content": intent_prompt}],
-                max_tokens=5,
-                temperature=0.1
-            )
-            
-            intent = response.choices[0].message.content.strip().lower()
-            return intent if intent in ["activate", "deactivate"] else "neither"
-            
+        
+        return {
+            "model": os.getenv("AZURE_DEPLOYMENT", "gpt-5-chat"),
+            "messages": [{"role": "user", "content": intent_prompt}],
+            "max_tokens": 5,
+            "temperature": 0.1
+        }
+    
+    def parse_intent(self, response) -> str:
+        intent = response.choices[0].message.content.strip().lower()
+        return intent if intent in ["activate", "deactivate"] else "neither"
+    
+    @contextmanager
+    def deadline(self, seconds: Optional[float] = None):
+        """Run a request under a time budget that LLM stages draw from"""
+        token = _request_deadline.set(Deadline(seconds or self.request_deadline_s))
+        try:
+            yield
+        finally:
+            _request_deadline.reset(token)
+    
+    def llm_timeout(self, stage: str) -> float:
+        """This stage's slice of the request budget; raises LLMUnavailable when it's too small or the circuit is open"""
+        if not self.breaker.allow():
+            self.metrics.inc("harsha_llm_skipped_total", {"stage": stage, "reason": "circuit_open"})
+            raise LLMUnavailable("circuit open")
+        
+        share, cap = self.stage_budgets.get(stage, (1.0, self.request_deadline_s))
+        deadline = _request_deadline.get()
+        timeout = min(cap, deadline.remaining() * share) if deadline else cap
+        if timeout < self.min_llm_budget_s:
+            self.metrics.inc("harsha_llm_skipped_total", {"stage": stage, "reason": "deadline"})
+            raise LLMUnavailable("request deadline exhausted")
+        return timeout
+    
+    def complete(self, stage: str, request: Dict):
+        """One LLM completion within its deadline budget, timed, with token usage recorded"""
+        timeout = self.llm_timeout(stage)
+        try:
+            with self.metrics.timer(stage):
+                response = self.llm.complete(timeout=timeout, **request)
+        except Exception:
+            self.metrics.inc("harsha_llm_failures_total", {"stage": stage})
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self.metrics.record_usage(stage, response)
+        return response
+    
+    async def acomplete(self, stage: str, request: Dict):
+        timeout = self.llm_timeout(stage)
+        try:
+            with self.metrics.timer(stage):
+                response = await self.llm.acomplete(timeout=timeout, **request)
+        except Exception:
+            self.metrics.inc("harsha_llm_failures_total", {"stage": stage})
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self.metrics.record_usage(stage, response)
+        return response
+    
+    def probe_llm(self):
+        """Cheapest possible completion, used to detect that the LLM has recovered"""
+        self.llm.complete(
+            model=os.getenv("AZURE_DEPLOYMENT", "gpt-5-chat"),
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+            timeout=self.stage_budgets["llm_intent"][1]
+        )
+    
+    def detect_intent(self, message: str) -> str:
+        """Detect activation/deactivation intent, locally if clear-cut, else via LLM"""
+        local_intent = self.intent_classifier.classify(message)
+        if local_intent:
+            return local_intent
+        
+        try:
+            response = self.complete("llm_intent", self.intent_request(message))
+            return self.parse_intent(response)
         except Exception as e:
             print(f"Intent detection error: {e}")
             # Fallback to keyword detection
-            message_lower = message.lower()
-            if any(word in message_lower for word in ["talk to alter", "activate", "turn on", "start ai", "bot mode"]):
-                return "activate"
-            elif any(word in message_lower for word in ["bye alter", "deactivate", "turn off", "stop", "disable"]):
-                return "deactivate"
-            return "neither"
+            return self.intent_classifier.keyword_intent(message)
+    
+    async def detect_intent_async(self, message: str) -> str:
+        """detect_intent on the async client"""
+        local_intent = self.intent_classifier.classify(message)
+        if local_intent:
+            return local_intent
+        
+        try:
+            response = await self.acomplete("llm_intent", self.intent_request(message))
+            return self.parse_intent(response)
+        except Exception as e:
+            print(f"Intent detection error: {e}")
+            return self.intent_classifier.keyword_intent(message)
     
     # FUNCTION IMPLEMENTATIONS
     def start_emoji_game(self, user_id: str) -> str:
         puzzle = random.choice(self.games["emoji_puzzles"])
-        self.game_states[user_id] = {"type": "emoji", "answer": puzzle[1]}
+        self.game_states.set(user_id, {"type": "emoji", "answer": puzzle[1]})
         return f"decode this movie: {puzzle[0]} 🎬"
     
     def start_math_game(self, user_id: str) -> str:
         a, b = random.randint(10, 99), random.randint(10, 99)
         answer = a + b
-        self.game_states[user_id] = {"type": "math", "answer": str(answer)}
+        self.game_states.set(user_id, {"type": "math", "answer": str(answer)})
         return f"quick maths! {a} + {b} = ? ⏱️"
     
     def roast_user(self, user_id: str) -> str:
@@ -306,8 +2884,20 @@ class HarshaMemoryAPI:
         return random.choice(self.games["hype"])
     
     def recall_memory(self, user_id: str, topic: str) -> str:
+        if self.vectors:
+            recalled = self.semantic_recall(user_id, topic)
+            if recalled:
+                return recalled
         return self.search_memory(user_id, topic)
     
+    def activate_alter_ego(self, user_id: str) -> str:
+        self.set_ai_active(user_id, True)
+        return self.activation_reply
+    
+    def deactivate_alter_ego(self, user_id: str) -> str:
+        self.set_ai_active(user_id, False)
+        return self.deactivation_reply
+    
     def handle_function_call(self, user_id: str, function_name: str, arguments: Dict) -> str:
         """Execute AI function calls"""
         try:
@@ -322,6 +2912,10 @@ class HarshaMemoryAPI:
             elif function_name == "recall_memory":
                 topic = arguments.get("topic", "")
                 return self.recall_memory(user_id, topic)
+            elif function_name == "activate_alter_ego":
+                return self.activate_alter_ego(user_id)
+            elif function_name == "deactivate_alter_ego":
+                return self.deactivate_alter_ego(user_id)
             else:
                 return "function not found lol"
         except Exception as e:
@@ -338,148 +2932,458 @@ class HarshaMemoryAPI:
                     return random.choice(responses)
         return None
     
+    def record_game_win(self, user_id: str):
+        """Increment games_won"""
+        self.writer.record_game_win(user_id)
+        self.user_cache.apply(user_id, add_fields={"games_won": 1})
+    
     def handle_ongoing_games(self, user_id: str, message: str) -> str:
         """Handle active games"""
-        if user_id not in self.game_states:
+        game = self.game_states.get(user_id)
+        if not game:
             return None
         
-        game = self.game_states[user_id]
-        
         if game["type"] == "emoji":
             if game["answer"].lower() in message.lower():
-                del self.game_states[user_id]
-                # Update wins
-                cursor = self.conn.cursor()
-                cursor.execute("UPDATE user_stats SET games_won = COALESCE(games_won, 0) + 1 WHERE user_id = ?", (user_id,))
-                self.conn.commit()
+                self.game_states.delete(user_id)
+                self.record_game_win(user_id)
                 return "yooo! 🏆 big brain energy! another?"
             return "nope! try again 🤔"
         
         elif game["type"] == "math":
             if message.strip() == game["answer"]:
-                del self.game_states[user_id]
-                cursor = self.conn.cursor()
-                cursor.execute("UPDATE user_stats SET games_won = COALESCE(games_won, 0) + 1 WHERE user_id = ?", (user_id,))
-                self.conn.commit()
+                self.game_states.delete(user_id)
+                self.record_game_win(user_id)
                 return "genius! 🧠⚡ more math?"
-            del self.game_states[user_id]
+            self.game_states.delete(user_id)
             return f"nah it was {game['answer']} 💀"
         
         return None
     
-    def generate_ai_response(self, message: str, user_id: str) -> str:
-        """AI with memory and functions"""
-        try:
-            history = self.get_conversation_history(user_id, limit=8)
-            stats = self.get_user_stats(user_id)
-            
-            system_prompt = f"""You are Harsha's chaotic alter ego. Keep responses under 100 chars.
+    def chat_request(self, message: str, history: List[Dict], stats: Dict, summary: Optional[str] = None) -> Dict:
+        """Completion arguments for the reply, with memory and functions"""
+        system_prompt = f"""You are Harsha's chaotic alter ego. Keep responses under 100 chars.
             Use gen-z slang (bet, no cap, fr, lowkey, say less). Be witty and unpredictable.
             
             User has sent {stats['total_messages']} messages, won {stats['games_won']} games.
             Use functions when appropriate. Remember previous conversations."""
+        if summary:
+            system_prompt += f"\nWhat you remember about this user: {summary}"
+        
+        functions = self.functions
+        if self.intent_mode == "merged":
+            functions = self.functions + self.intent_functions
+            system_prompt += "\nIf the user wants to stop chatting with you, call deactivate_alter_ego."
+        
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend(history)  # Already packed to the context budget
+        messages.append({"role": "user", "content": message})
+        
+        return {
+            "model": os.getenv("AZURE_DEPLOYMENT", "gpt-5-chat"),
+            "messages": messages,
+            "functions": functions,
+            "function_call": "auto",
+            "max_tokens": 50,
+            "temperature": 0.9
+        }
+    
+    def run_function_call(self, user_id: str, function_name: str, arguments: Dict) -> str:
+        self.metrics.path("function_call")
+        self.metrics.inc("harsha_function_calls_total", {"function": function_name})
+        with self.metrics.timer("function_call"):
+            return self.handle_function_call(user_id, function_name, arguments)
+    
+    def handle_completion(self, user_id: str, response, cache_key: Optional[str] = None,
+                          context: str = "", stamp: tuple = ()) -> str:
+        """Turn a reply completion into text, running its function call if any
+        (and recording it in the response cache under `cache_key`)"""
+        response_message = response.choices[0].message
+        
+        # Handle function calls
+        if response_message.function_call:
+            function_name = response_message.function_call.name
+            function_args = json.loads(response_message.function_call.arguments or "{}")
+            if cache_key:
+                self.response_cache.remember(user_id, cache_key, context, stamp, (function_name, function_args), "")
+            return self.run_function_call(user_id, function_name, function_args)
+        
+        self.metrics.path("ai")
+        if cache_key and response_message.content:
+            self.response_cache.remember(user_id, cache_key, context, stamp, None, response_message.content)
+        return response_message.content or "..."
+    
+    @staticmethod
+    def cache_context(history: List[Dict], summary: Optional[str], stats: Dict) -> Tuple[str, tuple]:
+        """(last assistant turn, reply stamp) for the response cache.
+
+        Routes are keyed on the assistant turn being answered; a cached reply is
+        only reused while everything that goes into the prompt is unchanged.
+        """
+        context = next((turn["content"] for turn in reversed(history) if turn["role"] == "assistant"), "")
+        history_digest = hashlib.sha1(json.dumps(history, sort_keys=True).encode()).hexdigest()
+        return context, (summary, stats["games_won"], history_digest)
+    
+    def cached_route(self, message: str, context: str) -> Tuple[Optional[str], Optional[Tuple[str, Dict]]]:
+        """(response cache key, settled function route) for a message answering the
+        assistant turn `context`; (None, None) when uncacheable"""
+        if not self.response_cache:
+            return None, None
+        cache_key = self.response_cache.key(message)
+        if not cache_key:
+            return None, None
+        route = self.response_cache.route(cache_key, context)
+        if route:
+            self.metrics.inc("harsha_response_cache_hits_total", {"tier": "route"})
+        return cache_key, route
+    
+    def cached_reply(self, user_id: str, cache_key: Optional[str], stamp: tuple) -> Optional[str]:
+        if not cache_key:
+            return None
+        reply = self.response_cache.reply(user_id, cache_key, stamp)
+        if reply is not None:
+            self.metrics.path("cached_reply")
+            self.metrics.inc("harsha_response_cache_hits_total", {"tier": "reply"})
+        return reply
+    
+    def generate_ai_response(self, message: str, user_id: str) -> str:
+        """AI with memory and functions; the response cache is checked before the LLM"""
+        try:
+            with self.metrics.timer("history"):
+                history, summary = self.build_context(user_id)
+                stats = self.get_user_stats(user_id)
             
-            messages = [{"role": "system", "content": system_prompt}]
-            messages.extend(history[-6:])  # Last 6 messages for context
-            messages.append({"role": "user", "content": message})
-            
-            response = self.ai_client.chat.completions.create(
-                model=os.getenv("AZURE_DEPLOYMENT", "gpt-5-chat"),
-                messages=messages,
-                functions=self.functions,
-                function_call="auto",
-                max_tokens=50,
-                temperature=0.9
-            )
+            context, stamp = self.cache_context(history, summary, stats)
+            cache_key, route = self.cached_route(message, context)
+            if route:
+                return self.run_function_call(user_id, *route)
+            reply = self.cached_reply(user_id, cache_key, stamp)
+            if reply is not None:
+                return reply
             
-            response_message = response.choices[0].message
+            response = self.complete("llm_reply", self.chat_request(message, history, stats, summary))
+            return self.handle_completion(user_id, response, cache_key, context, stamp)
             
-            # Handle function calls
-            if response_message.function_call:
-                function_name = response_message.function_call.name
-                function_args = json.loads(response_message.function_call.arguments or "{}")
-                return self.handle_function_call(user_id, function_name, function_args)
+        except Exception as e:
+            print(f"AI Error: {e}")
+            return random.choice(["my brain glitched 🤖", "error 404: wit not found"])
+    
+    async def generate_ai_response_async(self, message: str, user_id: str, history: List[Dict], stats: Dict,
+                                         summary: Optional[str] = None) -> str:
+        """generate_ai_response on the async client, with prefetched context and stats"""
+        try:
+            context, stamp = self.cache_context(history, summary, stats)
+            cache_key, route = self.cached_route(message, context)
+            if route:
+                return await asyncio.to_thread(self.run_function_call, user_id, *route)
+            reply = self.cached_reply(user_id, cache_key, stamp)
+            if reply is not None:
+                return reply
             
-            return response_message.content or "..."
+            response = await self.acomplete("llm_reply", self.chat_request(message, history, stats, summary))
+            # Function calls may touch the database
+            return await asyncio.to_thread(self.handle_completion, user_id, response, cache_key, context, stamp)
             
         except Exception as e:
             print(f"AI Error: {e}")
             return random.choice(["my brain glitched 🤖", "error 404: wit not found"])
     
+    def reply(self, user_id: str, message: str) -> str:
+        """/chat entry point: serialized per user, with bursts coalesced within COALESCE_WINDOW_MS"""
+        if self.mailboxes:
+            return self.mailboxes.submit(user_id, message, self.process_messages)
+        return self.process_message(user_id, message)
+    
+    async def reply_async(self, user_id: str, message: str) -> str:
+        if self.mailboxes:
+            return await self.mailboxes.submit_async(user_id, message, self.process_messages_async)
+        return await self.process_message_async(user_id, message)
+    
     def process_message(self, user_id: str, message: str) -> str:
         """Main processing with memory and AI activation control"""
-        if not message.strip():
-            return ""
+        return self.process_messages(user_id, [message])[0]
+    
+    def process_messages(self, user_id: str, messages: List[str]) -> List[str]:
+        """Answer a user's queued messages in order, one reply each.
+
+        Consecutive messages bound for the AI get a single combined reply,
+        returned for the last of them ("" for the others).
+        """
+        replies = [""] * len(messages)
+        run: List[int] = []
         
-        message = message.strip()
-        message_lower = message.lower()
+        def flush():
+            if run:
+                replies[run[-1]] = self.answer_with_ai(user_id, [messages[i].strip() for i in run])
+                run.clear()
         
-        # Use LLM to detect activation/deactivation intent
-        intent = self.detect_intent(message)
+        for i, message in enumerate(messages):
+            message = message.strip()
+            if not message:
+                self.metrics.path("empty")
+                continue
+            
+            intent = self.classify_intent(user_id, message)
+            route = self.message_route(user_id, message, intent)
+            if route != "ai" and run:
+                # The pending AI reply may start a game or toggle the alter ego
+                flush()
+                route = self.message_route(user_id, message, intent)
+            
+            if route == "ai":
+                run.append(i)
+            else:
+                replies[i] = self.answer(user_id, message, route)
         
+        flush()
+        return replies
+    
+    def classify_intent(self, user_id: str, message: str) -> str:
+        with self.metrics.timer("intent"):
+            if self.intent_mode == "merged" and self.is_ai_active(user_id):
+                # Active user: only clear-cut intents are handled here, the rest is
+                # classified by the main completion via the intent functions
+                return self.intent_classifier.classify(message) or "neither"
+            # Detect activation/deactivation intent (local fast path, LLM only if ambiguous)
+            return self.detect_intent(message)
+    
+    def message_route(self, user_id: str, message: str, intent: str) -> str:
+        """Which path answers the message (no side effects): activate, deactivate,
+        inactive_drop, game, quick_reply or ai"""
         if intent == "activate":
-            self.set_ai_active(user_id, True)
-            return "🤖 Alter ego activated! Ready to chat with chaotic energy! What's good?"
+            return "activate"
         
+        active = self.is_ai_active(user_id)
         if intent == "deactivate":
-            if self.is_ai_active(user_id):
-                self.set_ai_active(user_id, False)
-                return "✌️ Alter ego deactivated. Peace out! Say something like 'talk to alter' to reactivate."
-            else:
-                return ""  # Don't respond if AI wasn't active
+            return "deactivate" if active else "inactive_drop"  # Don't respond if AI wasn't active
+        if not active:
+            return "inactive_drop"
         
-        # Check if AI is active for this user
-        if not self.is_ai_active(user_id):
-            return ""  # Return empty response if AI is not active
+        if self.game_states.get(user_id):
+            return "game"
+        if self.get_quick_response(message):
+            return "quick_reply"
+        return "ai"
+    
+    def answer(self, user_id: str, message: str, route: str) -> str:
+        """Run a non-AI route"""
+        if route == "game":
+            with self.metrics.timer("games"):
+                game_response = self.handle_ongoing_games(user_id, message)
+            if game_response:
+                self.metrics.path("game")
+                return game_response
+            return self.answer_with_ai(user_id, [message])  # game ended meanwhile
         
-        # AI is active - proceed with normal processing
+        self.metrics.path(route)
+        if route == "activate":
+            return self.activate_alter_ego(user_id)
+        if route == "deactivate":
+            return self.deactivate_alter_ego(user_id)
+        if route == "quick_reply":
+            return self.get_quick_response(message)
+        return ""
+    
+    def answer_with_ai(self, user_id: str, messages: List[str]) -> str:
+        """One AI reply (with memory & functions) for one or more consecutive messages"""
+        message = "\n".join(messages)
+        if len(messages) > 1:
+            self.metrics.inc("harsha_coalesced_messages_total", value=len(messages) - 1)
         
-        # 1. Handle ongoing games
-        game_response = self.handle_ongoing_games(user_id, message)
-        if game_response:
-            return game_response
+        ai_response = self.generate_ai_response(message, user_id)
+        with self.metrics.timer("save"):
+            # One row per inbound message so message counts stay exact; the reply goes on the last
+            for earlier in messages[:-1]:
+                self.save_conversation(user_id, earlier, "")
+            self.save_conversation(user_id, messages[-1], ai_response)
+        return ai_response
+    
+    async def process_messages_async(self, user_id: str, messages: List[str]) -> List[str]:
+        """process_messages on the event loop; single messages take the async pipeline"""
+        if len(messages) == 1:
+            return [await self.process_message_async(user_id, messages[0])]
+        return await asyncio.to_thread(self.process_messages, user_id, messages)
+    
+    async def process_message_async(self, user_id: str, message: str) -> str:
+        """process_message as an async pipeline: history and stats load while intent is detected"""
+        if not message.strip():
+            self.metrics.path("empty")
+            return ""
         
-        # 2. Quick responses for simple messages
-        quick = self.get_quick_response(message)
-        if quick:
-            return quick
+        message = message.strip()
         
-        # 3. AI response with memory & functions
-        ai_response = self.generate_ai_response(message, user_id)
+        intent_started = time.perf_counter()
+        intent_task = None
+        if self.intent_mode != "merged":
+            intent_task = asyncio.ensure_future(self.detect_intent_async(message))
         
-        # 4. Save conversation
-        self.save_conversation(user_id, message, ai_response)
+        stats = await asyncio.to_thread(self.get_user_stats, user_id)
+        active = stats["ai_active"]
         
-        return ai_response
+        # Active users will most likely need a reply, so fetch its context now
+        history_task = None
+        if active:
+            history_task = asyncio.ensure_future(asyncio.to_thread(self.build_context, user_id))
+        
+        try:
+            if intent_task:
+                intent = await intent_task
+            elif active:
+                intent = self.intent_classifier.classify(message) or "neither"
+            else:
+                intent = await self.detect_intent_async(message)
+            self.metrics.observe("harsha_stage_seconds", time.perf_counter() - intent_started, {"stage": "intent"})
+            
+            if intent == "activate":
+                self.metrics.path("activate")
+                return await asyncio.to_thread(self.activate_alter_ego, user_id)
+            
+            if intent == "deactivate":
+                if active:
+                    self.metrics.path("deactivate")
+                    return await asyncio.to_thread(self.deactivate_alter_ego, user_id)
+                self.metrics.path("inactive_drop")
+                return ""  # Don't respond if AI wasn't active
+            
+            if not active:
+                self.metrics.path("inactive_drop")
+                return ""
+            
+            with self.metrics.timer("games"):
+                game_response = await asyncio.to_thread(self.handle_ongoing_games, user_id, message)
+            if game_response:
+                self.metrics.path("game")
+                return game_response
+            
+            quick = self.get_quick_response(message)
+            if quick:
+                self.metrics.path("quick_reply")
+                return quick
+            
+            with self.metrics.timer("history"):
+                history, summary = await history_task
+            ai_response = await self.generate_ai_response_async(message, user_id, history, stats, summary)
+            with self.metrics.timer("save"):
+                await asyncio.to_thread(self.save_conversation, user_id, message, ai_response)
+            
+            return ai_response
+        finally:
+            if history_task and not history_task.done():
+                history_task.cancel()
+
+    def warmup(self):
+        """Pre-open the LLM connection pool so the first request skips TLS setup"""
+        self.llm.warmup()
+    
+    async def awarmup(self):
+        await self.llm.awarmup()
+
+# The API is built lazily, once per process: importing this module opens nothing, and
+# gunicorn --preload workers each build their own after the fork (SQLite connections,
+# writer threads and HTTP pools don't survive one).
+_harsha: Optional[HarshaMemoryAPI] = None
+_harsha_lock = threading.Lock()
+
+def get_harsha() -> HarshaMemoryAPI:
+    global _harsha
+    if _harsha is None:
+        with _harsha_lock:
+            if _harsha is None:
+                _harsha = HarshaMemoryAPI()
+    return _harsha
+
+def _reset_after_fork():
+    global _harsha, _harsha_lock
+    _harsha = None
+    _harsha_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+harsha = LocalProxy(get_harsha)
+
+def manychat_reply(response: str) -> Dict:
+    """ManyChat Dynamic Block payload; no messages means nothing is sent"""
+    if not response:
+        # AI not active - return empty messages array (no response sent)
+        return {
+            "version": "v2",
+            "content": {
+                "messages": []
+            }
+        }
+    
+    # AI active - return message in ManyChat format
+    return {
+        "version": "v2",
+        "content": {
+            "messages": [
+                {
+                    "type": "text",
+                    "text": response
+                }
+            ]
+        }
+    }
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 8))
+
+def chat_reply(user_id: str, message: str, message_id: Optional[str] = None, dedup_window: bool = True) -> str:
+    """Reply to one delivery: deduplicated, traced and within the request deadline.
+    dedup_window=False deduplicates on message_id only (no same-text window)."""
+    future, first = Future(), True
+    if harsha.dedup and (message_id or dedup_window):
+        future, first = harsha.dedup.claim(user_id, message, message_id)
+    if not first:
+        harsha.metrics.inc("harsha_duplicate_requests_total", {"state": "completed" if future.done() else "in_flight"})
+        return future.result(timeout=harsha.request_deadline_s)
+    
+    start_time = time.time()
+    try:
+        with harsha.metrics.trace() as trace, harsha.deadline():
+            response = harsha.reply(user_id, message)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    future.set_result(response)
+    harsha.metrics.finish_request(user_id, time.time() - start_time, trace)
+    return response
 
-# Initialize API
-harsha = HarshaMemoryAPI()
+CHAT_ERROR = {
+    "error": "Something went wrong",
+    "response": "my circuits are having a moment 🤖"
+}
 
-@app.route('/', methods=['GET'])
+@bp.route('/', methods=['GET'])
 def home():
     return jsonify({
         "status": "🔥 Harsha's Memory API is LIVE!",
         "features": ["Persistent Memory", "Function Calling", "Games", "Stats"],
         "endpoints": {
             "chat": "POST /chat",
+            "chat_batch": "POST /chat/batch",
             "memory": "GET /memory/{user_id}",
             "stats": "GET /stats",
+            "metrics": "GET /metrics",
             "health": "GET /health"
         }
     })
 
-@app.route('/health', methods=['GET'])
+@bp.route('/health', methods=['GET'])
 def health():
     """Health check endpoint for monitoring"""
     try:
-        # Test database connection
-        cursor = harsha.conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.fetchone()
+        # Test every shard's database connection
+        for db in harsha.store.pools:
+            with db.read() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
         
         return jsonify({
             "status": "healthy",
             "database": "connected",
+            "shards": len(harsha.store),
             "timestamp": datetime.now().isoformat()
         })
     except Exception as e:
@@ -489,7 +3393,7 @@ def health():
             "timestamp": datetime.now().isoformat()
         }), 500
 
-@app.route('/chat', methods=['POST'])
+@bp.route('/chat', methods=['POST'])
 def chat():
     """Main chat with memory"""
     try:
@@ -498,79 +3402,248 @@ def chat():
         if not data or 'message' not in data:
             return jsonify({"error": "Missing 'message'"}), 400
         
-        user_id = data.get('user_id', 'anonymous')
+        user_id = str(data.get('user_id', 'anonymous'))  # ManyChat may send numeric ids
         message = data.get('message', '')
+        message_id = data.get('message_id') or request.headers.get('Idempotency-Key')
         
-        start_time = time.time()
-        response = harsha.process_message(user_id, message)
-        processing_time = time.time() - start_time
-        
-        # Get stats AFTER processing to reflect any changes made during processing
-        stats = harsha.get_user_stats(user_id)
+        response = chat_reply(user_id, message, message_id)
         
         # Return ManyChat Dynamic Block format
-        if not response:
-            # AI not active - return empty messages array (no response sent)
-            return jsonify({
-                "version": "v2",
-                "content": {
-                    "messages": []
-                }
-            })
-        
-        # AI active - return message in ManyChat format
-        return jsonify({
-            "version": "v2",
-            "content": {
-                "messages": [
-                    {
-                        "type": "text",
-                        "text": response
-                    }
-                ]
-            }
-        })
+        return jsonify(manychat_reply(response))
         
     except Exception as e:
         print(f"API Error: {e}")
-        return jsonify({
-            "error": "Something went wrong",
-            "response": "my circuits are having a moment 🤖"
-        }), 500
+        return jsonify(CHAT_ERROR), 500
+
+@bp.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Many {user_id, message} items: users run concurrently, each user's items in order.
+    Streams one NDJSON result per item as it completes."""
+    data = request.json
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not all(isinstance(item, dict) and 'message' in item for item in items):
+        return jsonify({"error": "Expected 'items': [{user_id, message}, ...]"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {BATCH_MAX_ITEMS} items per batch"}), 413
+    
+    by_user: Dict[str, List[int]] = {}
+    for index, item in enumerate(items):
+        by_user.setdefault(str(item.get('user_id', 'anonymous')), []).append(index)
+    harsha.prefetch_user_states(list(by_user))
+    
+    results: "queue.Queue[Dict]" = queue.Queue()
+    
+    def run_user(user_id: str, indexes: List[int]):
+        for index in indexes:
+            item = items[index]
+            result = {"index": index, "user_id": user_id}
+            if 'id' in item:
+                result["id"] = item['id']
+            try:
+                # Items are distinct messages, not retries: only an explicit id deduplicates
+                message_id = item.get('message_id') or item.get('id')
+                result["response"] = chat_reply(user_id, item['message'], str(message_id) if message_id is not None else None,
+                                                dedup_window=False)
+            except Exception as e:
+                print(f"Batch item error: {e}")
+                result["error"] = str(e)
+            results.put(result)
+    
+    def stream():
+        pool = ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(by_user))), thread_name_prefix="chat-batch")
+        try:
+            for user_id, indexes in by_user.items():
+                pool.submit(run_user, user_id, indexes)
+            for _ in range(len(items)):
+                yield json.dumps(results.get()) + "\n"
+        finally:
+            # Client gone: users not started yet are dropped
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
 
-@app.route('/memory/<user_id>', methods=['GET'])
+@bp.route('/memory/<user_id>', methods=['GET'])
 def get_memory(user_id):
-    """Get conversation history"""
+    """Get conversation history: ?limit=&cursor= pages, or ?format=ndjson for a full export"""
     try:
+        cursor = request.args.get('cursor', type=int)
+        
+        if request.args.get('format') == 'ndjson':
+            lines = (json.dumps(row) + "\n" for row in harsha.iter_conversations(user_id, cursor))
+            return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+        
         limit = request.args.get('limit', 10, type=int)
-        history = harsha.get_conversation_history(user_id, limit)
+        rows, next_cursor = harsha.get_history_page(user_id, limit, cursor)
         stats = harsha.get_user_stats(user_id)
         
+        history = []
+        for row in reversed(rows):
+            history.extend([
+                {"role": "user", "content": row["message"]},
+                {"role": "assistant", "content": row["response"]}
+            ])
+        
         return jsonify({
             "user_id": user_id,
             "conversation_history": history,
-            "stats": stats
+            "stats": stats,
+            "next_cursor": next_cursor
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/stats', methods=['GET'])
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics"""
+    intent = harsha.intent_classifier.stats()
+    cache = harsha.user_cache.stats()
+    writer = harsha.writer.stats()
+    gauges = {
+        "harsha_intent_local_decisions": intent["local_decisions"],
+        "harsha_intent_llm_calls": intent["llm_calls"],
+        "harsha_user_cache_hits": cache["hits"],
+        "harsha_user_cache_misses": cache["misses"],
+        "harsha_user_cache_evictions": cache["evictions"],
+        "harsha_user_cache_size": cache["size"],
+        "harsha_writer_queue_depth": writer["queued"],
+        "harsha_writer_batches": writer["batches"],
+        "harsha_llm_circuit_open": int(harsha.breaker.is_open),
+        "harsha_llm_circuit_trips": harsha.breaker.trips
+    }
+    return Response(harsha.metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+@bp.route('/stats', methods=['GET'])
 def global_stats():
-    """Global bot stats"""
+    """Global bot stats, from incrementally maintained counters summed across shards"""
     try:
-        cursor = harsha.conn.cursor()
-        cursor.execute("SELECT COUNT(DISTINCT user_id), COUNT(*), SUM(games_won) FROM conversations LEFT JOIN user_stats ON conversations.user_id = user_stats.user_id")
-        row = cursor.fetchone()
+        stats = dict.fromkeys(COUNTER_NAMES, 0)
+        for db in harsha.store.pools:
+            with db.read() as cursor:
+                cursor.execute(GLOBAL_STATS_QUERY)
+                for name, value in cursor.fetchall():
+                    stats[name] += value
         
-        return jsonify({
-            "total_users": row[0] or 0,
-            "total_messages": row[1] or 0,
-            "total_games_won": row[2] or 0
+        stats.update({
+            "intent_classifier": harsha.intent_classifier.stats(),
+            "user_cache": harsha.user_cache.stats(),
+            "writer": harsha.writer.stats(),
+            "archive": harsha.archive.stats()
         })
+        if harsha.dedup:
+            stats["dedup"] = harsha.dedup.stats()
+        if harsha.response_cache:
+            stats["response_cache"] = harsha.response_cache.stats()
+        if harsha.mailboxes:
+            stats["mailboxes"] = harsha.mailboxes.stats()
+        if harsha.vectors:
+            stats["vector_index"] = harsha.vectors.stats()
+        
+        # Optional time series: /stats?period=hour&buckets=24
+        period = request.args.get('period')
+        if period in ROLLUP_PERIODS:
+            buckets = min(request.args.get('buckets', 24, type=int), 24 * 31)
+            span = timedelta(hours=buckets) if period == "hour" else timedelta(days=buckets)
+            since = (datetime.now(timezone.utc) - span).strftime(ROLLUP_PERIODS[period])
+            rollups: Dict[tuple, int] = {}
+            for db in harsha.store.pools:
+                with db.read() as cursor:
+                    cursor.execute(ROLLUP_QUERY, (period, since))
+                    for bucket, name, value in cursor.fetchall():
+                        rollups[(bucket, name)] = rollups.get((bucket, name), 0) + value
+            stats["rollups"] = [{"bucket": bucket, "name": name, "value": value} for (bucket, name), value in sorted(rollups.items())]
+        
+        return jsonify(stats)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-if __name__ == '__main__':
+def create_app() -> Flask:
+    """WSGI app factory, e.g. gunicorn 'harsha_complete_api:create_app()'"""
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(bp)
+    return flask_app
+
+app = create_app()
+
+# ASGI SERVING MODE
+# /chat runs on the async pipeline; every other route is the Flask app behind a WSGI adapter.
+flask_asgi = WsgiToAsgi(app) if WsgiToAsgi else None
+
+async def send_json(send, payload: Dict, status: int = 200):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def asgi_chat(scope, receive, send):
+    """Main chat with memory (async)"""
+    try:
+        headers = dict(scope.get("headers") or [])
+        body = b""
+        more_body = True
+        while more_body:
+            event = await receive()
+            body += event.get("body", b"")
+            more_body = event.get("more_body", False)
+        data = json.loads(body or b"null")
+        
+        if not data or 'message' not in data:
+            await send_json(send, {"error": "Missing 'message'"}, 400)
+            return
+        
+        user_id = str(data.get('user_id', 'anonymous'))
+        message = data.get('message', '')
+        message_id = data.get('message_id') or headers.get(b"idempotency-key", b"").decode() or None
+        
+        future, first = Future(), True
+        if harsha.dedup:
+            future, first = harsha.dedup.claim(user_id, message, message_id)
+        if not first:
+            harsha.metrics.inc("harsha_duplicate_requests_total", {"state": "completed" if future.done() else "in_flight"})
+            # shield: a timed-out duplicate must not cancel the shared future
+            response = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), harsha.request_deadline_s)
+            await send_json(send, manychat_reply(response))
+            return
+        
+        start_time = time.time()
+        try:
+            with harsha.metrics.trace() as trace, harsha.deadline():
+                response = await harsha.reply_async(user_id, message)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(response)
+        harsha.metrics.finish_request(user_id, time.time() - start_time, trace)
+        
+        await send_json(send, manychat_reply(response))
+        
+    except Exception as e:
+        print(f"API Error: {e}")
+        await send_json(send, CHAT_ERROR, 500)
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                api = await asyncio.to_thread(get_harsha)
+                await api.awarmup()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await asyncio.to_thread(harsha.writer.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    if scope["type"] == "http" and scope["path"] == "/chat" and scope["method"] == "POST":
+        await asgi_chat(scope, receive, send)
+    elif flask_asgi:
+        await flask_asgi(scope, receive, send)
+    else:
+        await send_json(send, {"error": "Not found"}, 404)
+
+def run_server():
     # Get port from environment (for deployment) or default to 5001
     port = int(os.getenv('PORT', 5001))
     
@@ -580,6 +3653,119 @@ if __name__ == '__main__':
     print("🤖 Features: Function calling, memory recall, user stats")
     print(f"💬 Test: curl -X POST http://localhost:{port}/chat -H 'Content-Type: application/json' -d '{{\"message\":\"hey remember me?\", \"user_id\":\"test123\"}}'")
     
+    if os.getenv('SERVER_MODE', 'wsgi').lower() == 'asgi':
+        import uvicorn
+        print("⚡ Serving async /chat pipeline (ASGI)")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port)
+        return
+    
+    get_harsha().warmup()
+    
     # Use debug=False in production
     debug_mode = os.getenv('FLASK_ENV') == 'development'
-    app.run(host='0.0.0.0', port=port, debug=debug_mode)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=debug_mode)
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Harsha's Complete Memory API")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="run the API server (default)")
+    commands.add_parser("migrate", help="apply pending schema migrations")
+    commands.add_parser("check-plans", help="fail if a hot query plans a table scan")
+    commands.add_parser("fts-backfill", help="(re)build the full-text index over existing conversations")
+    commands.add_parser("verify-counters", help="compare /stats counters against the base tables")
+    commands.add_parser("rebuild-counters", help="recompute /stats counters from the base tables")
+    commands.add_parser("archive", help="move every conversation older than ARCHIVE_AFTER_DAYS into the archive now")
+    commands.add_parser("vector-backfill", help="rebuild the semantic recall index from existing conversations")
+    reshard_parser = commands.add_parser("reshard", help="copy the HARSHA_SHARDS layout into a new shard count (rerun to catch up)")
+    reshard_parser.add_argument("shards", type=int, help="target shard count")
+    args = parser.parse_args(argv)
+    if args.command in (None, "serve"):
+        run_server()
+        return 0
+    store = ShardedStore.from_env(DB_PATH)
+    
+    if args.command == "migrate":
+        print(f"Schema version: {store.migrate()} ({len(store)} shards)")
+        return 0
+    
+    if args.command == "fts-backfill":
+        store.migrate()
+        built = True
+        for db in store.pools:
+            with db.exclusive() as conn:
+                built = build_fts_index(conn) and built
+                conn.commit()
+        print("✅ Full-text index rebuilt" if built else "❌ FTS5 unavailable")
+        return 0 if built else 1
+    
+    if args.command in ("verify-counters", "rebuild-counters"):
+        store.migrate()
+        drifted = False
+        for path, db in zip(store.paths, store.pools):
+            with db.exclusive() as conn:
+                if args.command == "rebuild-counters":
+                    rebuild_counters(conn)
+                    conn.commit()
+                stored = dict(conn.execute(GLOBAL_STATS_QUERY).fetchall())
+                truth = counter_truth(conn)
+            drift = {name: (stored.get(name, 0), truth[name]) for name in COUNTER_NAMES if stored.get(name, 0) != truth[name]}
+            for name, (have, want) in drift.items():
+                print(f"❌ {path} {name}: stored {have}, actual {want}")
+            if not drift:
+                print(f"✅ {path} counters match: {truth}")
+            drifted = drifted or bool(drift)
+        return 1 if drifted else 0
+    
+    if args.command == "reshard":
+        target = ShardedStore.from_env(DB_PATH, args.shards)
+        copied = reshard(store, target)
+        print(f"✅ Copied {copied['conversations']} conversations, {copied['users']} users, "
+              f"{copied['archive_blocks']} archive blocks into {len(target)} shards")
+        print(f"Rerun with writes stopped to catch up, then set HARSHA_SHARDS={args.shards} and restart")
+        return 0
+    
+    if args.command == "archive":
+        store.migrate()
+        archive = ConversationArchive.from_env(store)
+        if archive.max_age_days <= 0:
+            print("❌ Archiving disabled (ARCHIVE_AFTER_DAYS=0)")
+            return 1
+        while archive.compact():
+            pass
+        print(f"✅ Archived {archive.rows_archived} conversations")
+        return 0
+    
+    if args.command == "vector-backfill":
+        vectors = VectorIndex.from_env(DB_PATH)
+        if not vectors:
+            print("❌ Vector index disabled (VECTOR_INDEX=0 or numpy missing)")
+            return 1
+        vectors.clear()
+        for db in store.pools:
+            with db.read() as cursor:
+                cursor.execute("SELECT user_id, codec, data FROM conversation_archive")
+                for user_id, codec, data in cursor.fetchall():
+                    vectors.add([(turn[0], user_id, f"{turn[1]}\n{turn[2]}") for turn in decompress_block(codec, data)])
+                cursor.execute("SELECT id, user_id, message, response FROM conversations ORDER BY id")
+                while True:
+                    rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    vectors.add([(row[0], row[1], f"{row[2]}\n{row[3]}") for row in rows])
+        print(f"✅ Indexed {vectors.rows_added} conversations")
+        return 0
+    
+    if args.command == "check-plans":
+        store.migrate()
+        with store.pools[0].exclusive() as conn:
+            problems = check_query_plans(conn)
+        for problem in problems:
+            print(f"❌ {problem}")
+        if not problems:
+            print("✅ All hot queries use indexes")
+        return 1 if problems else 0
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import harsha_complete_api as harsha_api
+
+
+@pytest.fixture
+def make_api(tmp_path, monkeypatch):
+    """Build a HarshaMemoryAPI on a scratch database and the offline LLM stub"""
+    monkeypatch.setattr(harsha_api, "DB_PATH", str(tmp_path / "harsha_memory.db"))
+    monkeypatch.setenv("LLM_BACKEND", "stub")
+    monkeypatch.setenv("STUB_LATENCY", "fixed:0")
+    monkeypatch.setenv("VECTOR_INDEX", "0")
+    monkeypatch.setenv("SUMMARY_EVERY_N_TURNS", "0")
+    monkeypatch.setenv("ARCHIVE_INTERVAL_S", "3600")
+    built = []
+
+    def make(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        api = harsha_api.HarshaMemoryAPI()
+        built.append(api)
+        return api
+
+    yield make
+    for api in built:
+        api.writer.close()
+        api.archive.close()
+        api.store.close()
+
+
+@pytest.fixture
+def client_for(monkeypatch):
+    """Flask test client whose routes use the given HarshaMemoryAPI"""
+    def client(api):
+        monkeypatch.setattr(harsha_api, "_harsha", api)
+        return harsha_api.create_app().test_client()
+
+    return client
@@ -0,0 +1,36 @@
+from harsha_complete_api import GLOBAL_STATS_QUERY, counter_truth
+
+
+def test_compacted_history_pages_back_through_archive(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", ARCHIVE_AFTER_DAYS=30, ARCHIVE_BATCH_SIZE=4, ARCHIVE_BLOCK_ROWS=3)
+    for i in range(25):
+        api.save_conversation("alice", f"message {i}", f"response {i}")
+        api.save_conversation("bob", f"bob {i}", "ok")
+    with api.store.write("alice") as cursor:
+        # Both users' first 20 turns are old enough to archive
+        cursor.execute(
+            "UPDATE conversations SET timestamp = '2020-01-01 00:00:00' WHERE id IN "
+            "(SELECT id FROM conversations ORDER BY id LIMIT 40)"
+        )
+
+    while api.archive.compact():
+        pass
+
+    with api.store.read("alice") as cursor:
+        cursor.execute("SELECT COUNT(*) FROM conversations WHERE user_id = 'alice'")
+        assert cursor.fetchone()[0] == 5
+        cursor.execute("SELECT COALESCE(SUM(row_count), 0) FROM conversation_archive WHERE user_id = 'alice'")
+        assert cursor.fetchone()[0] == 20
+
+    turns, cursor = [], None
+    while True:
+        page, cursor = api.get_history_page("alice", limit=7, cursor=cursor)
+        turns += page
+        if cursor is None:
+            break
+    assert [turn["message"] for turn in turns] == [f"message {i}" for i in reversed(range(25))]
+    assert [turn["response"] for turn in turns] == [f"response {i}" for i in reversed(range(25))]
+    assert [turn["message"] for turn in api.iter_conversations("alice")] == [turn["message"] for turn in turns]
+
+    with api.store.pools[0].read() as cursor:
+        assert dict(cursor.execute(GLOBAL_STATS_QUERY).fetchall()) == counter_truth(cursor.connection)
@@ -0,0 +1,63 @@
+import json
+import threading
+
+
+def post_batch(client, items):
+    response = client.post("/chat/batch", json={"items": items})
+    assert response.mimetype == "application/x-ndjson"
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def recording_replies(api):
+    calls = []
+    lock = threading.Lock()
+
+    def reply(user_id, message):
+        with lock:
+            calls.append((user_id, message))
+        return f"{user_id}: {message}"
+
+    api.reply = reply
+    return calls
+
+
+def test_each_users_items_run_in_order(make_api, client_for):
+    api = make_api(DEDUP="1")
+    client = client_for(api)
+    calls = recording_replies(api)
+    items = [{"user_id": f"u{i % 3}", "message": f"message {i}"} for i in range(12)]
+
+    results = post_batch(client, items)
+    assert sorted(result["index"] for result in results) == list(range(12))
+    for result in results:
+        item = items[result["index"]]
+        assert result["user_id"] == item["user_id"]
+        assert result["response"] == f"{item['user_id']}: {item['message']}"
+    for user_id in ("u0", "u1", "u2"):
+        assert [message for caller, message in calls if caller == user_id] == [
+            item["message"] for item in items if item["user_id"] == user_id
+        ]
+
+
+def test_items_deduplicate_on_their_id_only(make_api, client_for):
+    api = make_api(DEDUP="1")
+    client = client_for(api)
+    calls = recording_replies(api)
+    items = [
+        {"user_id": "a", "message": "hi"},
+        {"user_id": "a", "message": "hi"},  # same text, no id: a separate message
+        {"user_id": "a", "message": "play", "id": 1},
+        {"user_id": "a", "message": "play", "id": 1},  # retried item
+        {"user_id": "b", "message": "play", "id": 1},  # ids are per user
+        {"user_id": 5, "message": "yo", "message_id": "x"},
+    ]
+
+    results = {result["index"]: result for result in post_batch(client, items)}
+    assert [message for user_id, message in calls if user_id == "a"] == ["hi", "hi", "play"]
+    assert sorted(call for call in calls if call[0] != "a") == [("5", "yo"), ("b", "play")]
+    assert results[3]["response"] == results[2]["response"] and results[3]["id"] == 1
+    assert results[5]["user_id"] == "5"
+
+    # Replaying the batch is absorbed by the item ids; id-less items run again
+    post_batch(client, items)
+    assert len(calls) == 7
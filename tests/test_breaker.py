@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from harsha_complete_api import CircuitBreaker, LLMUnavailable
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()  # one trial call per cooldown
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow()
+    assert breaker.trips == 1
+
+
+def test_probe_closes_the_breaker_once_it_succeeds():
+    attempts = []
+    closed = threading.Event()
+
+    def probe():
+        attempts.append(time.monotonic())
+        if len(attempts) < 2:
+            raise RuntimeError("still down")
+        closed.set()
+
+    breaker = CircuitBreaker(threshold=1, cooldown=0.02, probe=probe)
+    breaker.record_failure()
+    assert not breaker.allow()  # no trial calls while a probe owns recovery
+    assert closed.wait(2)
+    deadline = time.monotonic() + 1
+    while breaker.is_open and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert not breaker.is_open and len(attempts) == 2
+
+
+def test_stage_timeouts_are_capped_by_the_request_deadline(make_api):
+    api = make_api(LLM_INTENT_TIMEOUT_S="2", LLM_REPLY_TIMEOUT_S="6")
+    assert api.llm_timeout("llm_intent") == 2
+    assert api.llm_timeout("llm_reply") == 6
+
+    with api.deadline(100):
+        assert api.llm_timeout("llm_intent") == 2
+        assert api.llm_timeout("llm_reply") == 6
+    with api.deadline(1):
+        assert api.llm_timeout("llm_intent") <= 0.4
+        assert api.llm_timeout("llm_reply") <= 1
+    with api.deadline(0.1):
+        with pytest.raises(LLMUnavailable, match="deadline"):
+            api.llm_timeout("llm_reply")
+
+
+def test_failing_llm_trips_the_breaker_and_later_calls_skip_it(make_api):
+    api = make_api(LLM_BREAKER_THRESHOLD="2", LLM_BREAKER_COOLDOWN_S="60")
+    calls = []
+
+    def complete(timeout=None, **request):
+        calls.append(timeout)
+        raise TimeoutError("azure timed out")
+
+    api.llm.complete = complete
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            api.complete("llm_reply", {})
+    assert api.breaker.is_open
+
+    with pytest.raises(LLMUnavailable, match="circuit open"):
+        api.complete("llm_reply", {})
+    assert len(calls) == 2
+    # The reply path degrades to a canned line instead of waiting on the LLM
+    assert api.generate_ai_response("hello", "a") in ["my brain glitched 🤖", "error 404: wit not found"]
+    assert len(calls) == 2
+    api.breaker.record_success()  # stop the probe thread
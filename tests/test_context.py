@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import harsha_complete_api as harsha_api
+
+
+def summary_through(api, user_id):
+    with api.store.read(user_id) as cursor:
+        cursor.execute(harsha_api.SUMMARY_QUERY, (user_id,))
+        return cursor.fetchone()
+
+
+def conversation_ids(api, user_id):
+    with api.store.read(user_id) as cursor:
+        cursor.execute("SELECT id FROM conversations WHERE user_id = ? ORDER BY id", (user_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def test_pack_keeps_history_within_the_token_budget(make_api):
+    api = make_api(CONTEXT_TOKEN_BUDGET="120", CONTEXT_MAX_TURNS="20")
+    turns = [(f"message number {i} " * 3, f"response number {i} " * 3) for i in range(20)]
+    summary = "likes cats and bad puns"
+
+    history = api.context.pack(turns, summary)
+    used = harsha_api.estimate_tokens(summary) + sum(api.context.message_tokens(m["content"]) for m in history)
+    assert history and used <= 120
+    assert len(history) < 2 * len(turns)
+    # The newest turn survives, in chronological order at the end
+    assert history[-2:] == [
+        {"role": "user", "content": turns[0][0]},
+        {"role": "assistant", "content": turns[0][1]},
+    ]
+
+
+def test_refresh_summary_folds_oldest_turns_first_and_catches_up(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    folded = []
+
+    def complete(stage, request):
+        folded.append(request["messages"][0]["content"])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"summary {len(folded)}"))])
+
+    api.complete = complete
+    for i in range(70):
+        api.save_conversation("a", f"turn {i}", f"reply {i}")
+    ids = conversation_ids(api, "a")
+
+    api.refresh_summary("a")
+    assert summary_through(api, "a") == ("summary 1", ids[api.summary_batch - 1])
+    assert "turn 0\n" in folded[0] and "turn 49\n" in folded[0]
+
+    # The second run picks up where the first stopped and leaves the newest turns alone
+    api.refresh_summary("a")
+    assert summary_through(api, "a") == ("summary 2", ids[-api.summary_keep_turns - 1])
+    assert "turn 50\n" in folded[1] and "turn 66\n" not in folded[1]
+
+    api.refresh_summary("a")
+    assert len(folded) == 2
@@ -0,0 +1,37 @@
+import harsha_complete_api as harsha_api
+from harsha_complete_api import GLOBAL_STATS_QUERY, counter_truth
+
+
+def stored_counters(api):
+    with api.store.pools[0].read() as cursor:
+        return dict(cursor.execute(GLOBAL_STATS_QUERY).fetchall())
+
+
+def test_triggers_keep_counters_in_step_with_inserts_and_updates(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    for user_id in ("a", "b", "c"):
+        api.save_conversation(user_id, "hi", "hey")
+    api.save_conversation("a", "again", "yo")
+    api.record_game_win("a")
+    api.record_game_win("b")
+    api.activate_alter_ego("a")
+    api.activate_alter_ego("b")
+    api.deactivate_alter_ego("b")
+    api.activate_alter_ego("d")  # a user row with no messages yet
+
+    assert stored_counters(api) == {"total_users": 3, "total_messages": 4, "total_games_won": 2, "active_users": 2}
+    with api.store.pools[0].read() as cursor:
+        assert stored_counters(api) == counter_truth(cursor.connection)
+    assert harsha_api.main(["verify-counters"]) == 0
+
+
+def test_verify_counters_reports_drift_until_rebuilt(make_api, capsys):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    api.save_conversation("a", "hi", "hey")
+    with api.store.write("a") as cursor:
+        cursor.execute("UPDATE global_counters SET value = value + 5 WHERE name = 'total_messages'")
+
+    assert harsha_api.main(["verify-counters"]) == 1
+    assert "total_messages: stored 6, actual 1" in capsys.readouterr().out
+    assert harsha_api.main(["rebuild-counters"]) == 0
+    assert stored_counters(api)["total_messages"] == 1
@@ -0,0 +1,76 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import harsha_complete_api as harsha_api
+
+
+def slow_replies(api):
+    """Make api.reply slow and count how often it really runs"""
+    calls = []
+    started, release = threading.Event(), threading.Event()
+
+    def reply(user_id, message):
+        calls.append(message)
+        started.set()
+        release.wait(2)
+        return f"reply {len(calls)}"
+
+    api.reply = reply
+    return calls, started, release
+
+
+def test_concurrent_retries_share_the_first_delivery(make_api, client_for):
+    api = make_api(DEDUP="1")
+    client_for(api)
+    calls, started, release = slow_replies(api)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        first = pool.submit(harsha_api.chat_reply, "a", "hey", "m1")
+        assert started.wait(2)
+        retries = [pool.submit(harsha_api.chat_reply, "a", "hey", "m1") for _ in range(3)]
+        deadline = time.monotonic() + 2
+        while api.dedup.stats()["in_flight_hits"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        replies = [future.result() for future in [first] + retries]
+
+    assert replies == ["reply 1"] * 4
+    assert calls == ["hey"]
+    assert api.dedup.stats()["in_flight_hits"] == 3
+
+
+def test_retry_without_an_id_matches_on_text_and_keys_are_per_user(make_api, client_for):
+    api = make_api(DEDUP="1")
+    client = client_for(api)
+    calls, _, release = slow_replies(api)
+    release.set()
+
+    payload = {"user_id": 7, "message": "hey"}
+    assert client.post("/chat", json=payload).get_json() == client.post("/chat", json=payload).get_json()
+    assert len(calls) == 1
+    client.post("/chat", json={"user_id": 8, "message": "hey"})
+    assert len(calls) == 2
+    # Same text under a new message id is a new message
+    client.post("/chat", json=payload, headers={"Idempotency-Key": "m2"})
+    assert len(calls) == 3
+
+
+def test_failures_are_not_cached(make_api, client_for):
+    api = make_api(DEDUP="1")
+    client_for(api)
+    attempts = []
+
+    def reply(user_id, message):
+        attempts.append(message)
+        if len(attempts) == 1:
+            raise RuntimeError("db locked")
+        return "ok"
+
+    api.reply = reply
+    with pytest.raises(RuntimeError):
+        harsha_api.chat_reply("a", "hey", "m1")
+    assert harsha_api.chat_reply("a", "hey", "m1") == "ok"
+    assert len(attempts) == 2
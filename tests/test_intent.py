@@ -0,0 +1,92 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import harsha_complete_api as harsha_api
+
+KEYWORDS = {
+    "activate": ["talk to alter", "activate", "turn on", "start ai", "bot mode"],
+    "deactivate": ["bye alter", "deactivate", "turn off", "stop", "disable"],
+}
+
+
+def completion(content=None, function=None):
+    call = SimpleNamespace(name=function, arguments=json.dumps({})) if function else None
+    message = SimpleNamespace(content=content, function_call=call)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("activate", "activate"),
+    ("talk to alter", "activate"),
+    ("bot mode", "activate"),
+    ("STOP!!", "deactivate"),
+    ("bye alter", "deactivate"),
+    ("turn off", "deactivate"),
+    ("hello there", "neither"),
+    ("lol what 😂", "neither"),
+])
+def test_clear_cut_messages_are_decided_locally(message, intent):
+    classifier = harsha_api.IntentClassifier(KEYWORDS)
+    assert classifier.classify(message) == intent
+    assert classifier.stats()["local_decisions"] == 1
+
+
+@pytest.mark.parametrize("message", [
+    "dont stop",  # negation
+    "please can you turn off the bot now",  # too long to trust the keywords
+])
+def test_ambiguous_messages_go_to_the_llm(message):
+    classifier = harsha_api.IntentClassifier(KEYWORDS)
+    assert classifier.classify(message) is None
+    assert classifier.stats()["llm_calls"] == 1
+
+
+def test_detect_intent_only_calls_the_llm_when_ambiguous(make_api):
+    api = make_api()
+    calls = []
+
+    def complete(stage, request):
+        calls.append(stage)
+        return completion(content="neither")
+
+    api.complete = complete
+    assert api.detect_intent("stop") == "deactivate"
+    assert api.detect_intent("hey whats up") == "neither"
+    assert calls == []
+
+    assert api.detect_intent("dont stop") == "neither"
+    assert calls == ["llm_intent"]
+
+
+def test_merged_mode_deactivates_through_the_main_completion(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", INTENT_MODE="merged", RESPONSE_CACHE="0")
+    api.activate_alter_ego("a")
+    requests = []
+
+    def complete(stage, request):
+        requests.append((stage, request))
+        return completion(function="deactivate_alter_ego")
+
+    api.complete = complete
+    assert api.process_message("a", "ok im done for today") == api.deactivation_reply
+    assert not api.is_ai_active("a")
+
+    # One call: the reply completion, which offered the intent functions
+    [(stage, request)] = requests
+    assert stage == "llm_reply"
+    assert "deactivate_alter_ego" in [function["name"] for function in request["functions"]]
+
+    # Inactive again, so the next message is dropped without any completion
+    assert api.process_message("a", "hello?") == ""
+    assert len(requests) == 1
+
+
+def test_merged_mode_clear_cut_deactivation_skips_the_llm(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", INTENT_MODE="merged")
+    api.activate_alter_ego("a")
+    api.complete = lambda stage, request: pytest.fail(f"unexpected {stage} call")
+
+    assert api.process_message("a", "bye alter") == api.deactivation_reply
+    assert not api.is_ai_active("a")
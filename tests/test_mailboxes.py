@@ -0,0 +1,67 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import harsha_complete_api as harsha_api
+
+
+def recording_process(batches, delay=0.01):
+    """process() that records each batch, fails if a user's batches overlap,
+    and replies with the messages upper-cased"""
+    running = set()
+    lock = threading.Lock()
+
+    def process(user_id, messages):
+        with lock:
+            assert user_id not in running
+            running.add(user_id)
+            batches.append((user_id, list(messages)))
+        time.sleep(delay)
+        with lock:
+            running.discard(user_id)
+        return [message.upper() for message in messages]
+
+    return process
+
+
+def submit_in_order(mailboxes, process, user_id, messages):
+    """Submit from separate threads, each one queued before the next starts"""
+    with ThreadPoolExecutor(max_workers=len(messages)) as pool:
+        futures = []
+        for message in messages:
+            futures.append(pool.submit(mailboxes.submit, user_id, message, process))
+            time.sleep(0.002)
+        return [future.result() for future in futures]
+
+
+def test_no_window_processes_each_message_alone_in_order():
+    mailboxes = harsha_api.UserMailboxes(window=0.0, max_batch=10)
+    batches = []
+    messages = ["play a game", "🦁", "lion king", "again", "stop"]
+
+    replies = submit_in_order(mailboxes, recording_process(batches), "a", messages)
+    assert replies == [message.upper() for message in messages]
+    assert batches == [("a", [message]) for message in messages]
+
+
+def test_window_coalesces_a_burst_into_one_batch():
+    mailboxes = harsha_api.UserMailboxes(window=0.1, max_batch=3)
+    batches = []
+    messages = ["hey", "u there", "??", "hello"]
+
+    replies = submit_in_order(mailboxes, recording_process(batches), "a", messages)
+    assert replies == [message.upper() for message in messages]
+    assert batches == [("a", messages[:3]), ("a", messages[3:])]
+
+
+def test_users_are_processed_independently():
+    mailboxes = harsha_api.UserMailboxes(window=0.0)
+    together = threading.Barrier(4, timeout=2)
+
+    def process(user_id, messages):
+        together.wait()  # only passes if all four users are processed at once
+        return [user_id for _ in messages]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        replies = list(pool.map(lambda user_id: mailboxes.submit(user_id, "hi", process), ["a", "b", "c", "d"]))
+    assert replies == ["a", "b", "c", "d"]
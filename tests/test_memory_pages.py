@@ -0,0 +1,42 @@
+import json
+
+
+def test_keyset_pages_stay_continuous_while_new_turns_arrive(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    for i in range(23):
+        api.save_conversation("a", f"message {i}", f"response {i}")
+        api.save_conversation("b", f"other {i}", "ok")
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = api.get_history_page("a", limit=5, cursor=cursor)
+        seen += [row["message"] for row in page]
+        # Newer turns land above the cursor and never shift the pages still to come
+        api.save_conversation("a", f"new {len(seen)}", "ok")
+        if cursor is None:
+            break
+    assert seen == [f"message {i}" for i in reversed(range(23))]
+
+
+def test_memory_route_pages_and_ndjson_export(make_api, client_for):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    for i in range(12):
+        api.save_conversation("a", f"message {i}", f"response {i}")
+    client = client_for(api)
+
+    first = client.get("/memory/a?limit=5").get_json()
+    assert [turn["content"] for turn in first["conversation_history"] if turn["role"] == "user"] == [
+        f"message {i}" for i in range(7, 12)
+    ]
+    second = client.get(f"/memory/a?limit=5&cursor={first['next_cursor']}").get_json()
+    assert [turn["content"] for turn in second["conversation_history"] if turn["role"] == "user"] == [
+        f"message {i}" for i in range(2, 7)
+    ]
+    last = client.get(f"/memory/a?limit=5&cursor={second['next_cursor']}").get_json()
+    assert len(last["conversation_history"]) == 4 and last["next_cursor"] is None
+
+    export = client.get("/memory/a?format=ndjson")
+    assert export.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in export.get_data(as_text=True).splitlines()]
+    assert [row["message"] for row in rows] == [f"message {i}" for i in reversed(range(12))]
+    assert [row["id"] for row in rows] == sorted((row["id"] for row in rows), reverse=True)
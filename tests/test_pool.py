@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+
+import harsha_complete_api as harsha_api
+
+
+def test_concurrent_readers_never_grow_the_pool_past_its_size(tmp_path):
+    pool = harsha_api.SQLitePool(str(tmp_path / "pool.db"), size=3)
+    start = threading.Barrier(12)
+    held = threading.Event()
+
+    def reader():
+        start.wait()
+        with pool.read() as cursor:
+            cursor.execute("SELECT 1")
+            held.wait(0.05)
+
+    threads = [threading.Thread(target=reader) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(pool._all) == 1 + 3  # the writer plus `size` readers
+    pool.close()
+
+
+def test_checkout_times_out_with_a_descriptive_error(tmp_path):
+    pool = harsha_api.SQLitePool(str(tmp_path / "pool.db"), size=1, busy_timeout_ms=50)
+    with pool.read():
+        with pytest.raises(TimeoutError, match="SQLITE_POOL_SIZE"):
+            with pool.read():
+                pass
+    pool.close()
@@ -0,0 +1,70 @@
+import harsha_complete_api as harsha_api
+from harsha_complete_api import COUNTER_NAMES, GLOBAL_STATS_QUERY, ShardedStore, counter_truth, reshard
+
+USERS = [f"user{i}" for i in range(12)]
+
+
+def user_rows(store, user_id):
+    """(hot ids, archived row count, user_stats row) for one user"""
+    with store.read(user_id) as cursor:
+        cursor.execute("SELECT id FROM conversations WHERE user_id = ? ORDER BY id", (user_id,))
+        hot = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT COALESCE(SUM(row_count), 0) FROM conversation_archive WHERE user_id = ?", (user_id,))
+        archived = cursor.fetchone()[0]
+        cursor.execute("SELECT total_messages, games_won, ai_active FROM user_stats WHERE user_id = ?", (user_id,))
+        stats = cursor.fetchone()
+    return hot, archived, stats
+
+
+def counters(store):
+    totals = dict.fromkeys(COUNTER_NAMES, 0)
+    for db in store.pools:
+        with db.read() as cursor:
+            stored = dict(cursor.execute(GLOBAL_STATS_QUERY).fetchall())
+            assert stored == counter_truth(cursor.connection)
+        for name in COUNTER_NAMES:
+            totals[name] += stored[name]
+    return totals
+
+
+def test_reshard_one_to_three_keeps_every_user(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", ARCHIVE_AFTER_DAYS=30, ARCHIVE_BLOCK_ROWS=4)
+    for turn in range(6):
+        for user_id in USERS[:turn * 2 + 2]:
+            api.save_conversation(user_id, f"{user_id} says {turn}", "ok")
+    for user_id in USERS[::3]:
+        api.set_ai_active(user_id, True)
+        api.record_game_win(user_id)
+    with api.store.write(USERS[0]) as cursor:
+        cursor.execute("UPDATE conversations SET timestamp = '2020-01-01 00:00:00' WHERE id <= 10")
+    while api.archive.compact():
+        pass
+    assert sum(user_rows(api.store, user_id)[1] for user_id in USERS) == 10
+
+    source = api.store
+    target = ShardedStore(harsha_api.DB_PATH, 3)
+    reshard(source, target)
+
+    for user_id in USERS:
+        assert user_rows(target, user_id) == user_rows(source, user_id)
+    assert counters(target) == counters(source)
+    # Each user landed only on the shard their id routes to
+    for index, db in enumerate(target.pools):
+        with db.read() as cursor:
+            cursor.execute("SELECT DISTINCT user_id FROM conversations UNION SELECT user_id FROM user_stats")
+            assert {row[0] for row in cursor.fetchall()} <= {u for u in USERS if target.index(u) == index}
+
+    # Writes made after the first copy are picked up by a rerun, without duplicates
+    api.save_conversation(USERS[1], "late message", "ok")
+    reshard(source, target)
+    for user_id in USERS:
+        assert user_rows(target, user_id) == user_rows(source, user_id)
+    assert counters(target) == counters(source)
+
+    # New ids on the target continue above the source and stay unique per shard
+    high_water = max(max(user_rows(source, u)[0], default=0) for u in USERS)
+    resharded = make_api(CONVERSATION_DURABILITY="sync", HARSHA_SHARDS=3)
+    resharded.save_conversation(USERS[1], "after the switch", "ok")
+    new_id = user_rows(resharded.store, USERS[1])[0][-1]
+    assert new_id > high_water and new_id % 3 == resharded.store.index(USERS[1])
+    target.close()
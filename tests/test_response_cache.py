@@ -0,0 +1,64 @@
+import json
+from types import SimpleNamespace
+
+
+def completion(content=None, function=None):
+    call = SimpleNamespace(name=function, arguments=json.dumps({})) if function else None
+    message = SimpleNamespace(content=content, function_call=call)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def scripted(api, reply):
+    """Replace the LLM with `reply(request)`, counting the completions"""
+    calls = []
+
+    def complete(stage, request):
+        calls.append(request)
+        return reply(request)
+
+    api.complete = complete
+    return calls
+
+
+def test_route_is_keyed_on_the_preceding_assistant_turn(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", RESPONSE_CACHE="1", ROUTE_CACHE_MIN_HITS="2")
+    api.start_emoji_game = lambda user_id: "🎬🦁👑 guess the movie"
+    calls = scripted(api, lambda request: completion(function="start_emoji_game"))
+
+    for user_id in ("a", "b", "c"):
+        api.save_conversation(user_id, "that was fun", "another round?")
+    api.generate_ai_response("yes", "a")
+    api.generate_ai_response("yes", "b")
+    assert len(calls) == 2
+
+    # Same message answering the same question: the settled route is served
+    assert api.generate_ai_response("yes", "c") == "🎬🦁👑 guess the movie"
+    assert len(calls) == 2
+
+    # "yes" to something else must still go to the LLM
+    api.save_conversation("d", "tell me a joke", "want a darker one?")
+    calls = scripted(api, lambda request: completion(content="ok you asked for it"))
+    assert api.generate_ai_response("yes", "d") == "ok you asked for it"
+    assert len(calls) == 1
+
+
+def test_alter_ego_toggles_are_never_cached(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", RESPONSE_CACHE="1", ROUTE_CACHE_MIN_HITS="1")
+    calls = scripted(api, lambda request: completion(function="deactivate_alter_ego"))
+
+    for user_id in ("a", "b"):
+        api.generate_ai_response("ok bye", user_id)
+    assert len(calls) == 2
+
+
+def test_reply_is_dropped_when_recent_history_changes(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync", RESPONSE_CACHE="1")
+    calls = scripted(api, lambda request: completion(content=f"reply {len(calls)}"))
+
+    assert api.generate_ai_response("hi", "a") == "reply 1"
+    assert api.generate_ai_response("hi", "a") == "reply 1"
+    assert len(calls) == 1
+
+    api.save_conversation("a", "my cat died", "oh no 😢")
+    assert api.generate_ai_response("hi", "a") == "reply 2"
+    assert len(calls) == 2
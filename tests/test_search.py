@@ -0,0 +1,36 @@
+def seed(api):
+    api.save_conversation("a", "i had pizza once", "cool")
+    api.save_conversation("a", "pizza pizza pizza is my favourite pizza", "pizza gang 🍕")
+    api.save_conversation("a", "went hiking", "nice")
+    api.save_conversation("a", "i love pineapples", "weird")
+    api.save_conversation("b", "pizza is life", "true")
+
+
+def test_fts_ranks_best_matches_first_and_stays_per_user(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    assert api.fts_enabled
+    seed(api)
+
+    assert api.search_memory("a", "pizza") == (
+        "I remember we talked about pizza! pizza pizza pizza is my favourite pizza | i had pizza once"
+    )
+    assert api.search_memory("a", "pine") == "I remember we talked about pine! i love pineapples"  # prefix match
+    assert api.search_memory("b", "hiking") == "hmm don't think we've talked about hiking before"
+
+
+def test_like_fallback_for_untokenizable_topics(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    seed(api)
+
+    # No word characters to MATCH on, so the LIKE scan answers (and also searches responses)
+    assert api.fts_match_query("a", "🍕") is None
+    assert api.search_memory("a", "🍕") == "I remember we talked about 🍕! You said: pizza pizza pizza is my favourite pizza"
+
+
+def test_like_fallback_without_fts5(make_api):
+    api = make_api(CONVERSATION_DURABILITY="sync")
+    seed(api)
+    api.fts_enabled = False
+
+    assert api.search_memory("a", "hiking") == "I remember we talked about hiking! You said: went hiking"
+    assert api.search_memory("a", "tacos") == "hmm don't think we've talked about tacos before"
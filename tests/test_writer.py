@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from harsha_complete_api import ConversationWriter, ShardedStore, ShardedWriter
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_close_flushes_queued_rows(tmp_path, monkeypatch, shards):
+    monkeypatch.setenv("CONVERSATION_DURABILITY", "async")
+    monkeypatch.setenv("WRITE_FLUSH_MS", "60000")  # nothing commits on its own during the test
+    monkeypatch.setenv("WRITE_BATCH_SIZE", "1000")
+    store = ShardedStore(str(tmp_path / "harsha_memory.db"), shards)
+    store.migrate()
+    writer = ShardedWriter(store)
+
+    users = [f"user{i}" for i in range(8)]
+    for turn in range(5):
+        for user_id in users:
+            writer.save_conversation(user_id, f"message {turn}", "ok", f"2024-01-01T00:00:0{turn}")
+    writer.record_game_win(users[0])
+
+    def committed():
+        total = 0
+        for db in store.pools:
+            with db.read() as cursor:
+                total += cursor.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return total
+
+    assert committed() == 0  # held in the writers' queues and open batches
+
+    writer.close()
+
+    assert committed() == 40
+    for user_id in users:
+        with store.read(user_id) as cursor:
+            cursor.execute("SELECT message FROM conversations WHERE user_id = ? ORDER BY id", (user_id,))
+            assert [row[0] for row in cursor.fetchall()] == [f"message {turn}" for turn in range(5)]
+            cursor.execute("SELECT total_messages, games_won, last_active FROM user_stats WHERE user_id = ?", (user_id,))
+            assert cursor.fetchone() == (5, 1 if user_id == users[0] else 0, "2024-01-01T00:00:04")
+    assert writer.stats()["queued"] == 0
+    store.close()
+
+
+def test_save_racing_close_is_never_lost(tmp_path):
+    store = ShardedStore(str(tmp_path / "harsha_memory.db"))
+    store.migrate()
+    writer = ConversationWriter(store.pools[0], durability="async")
+
+    # Stall the enqueue after the closed-check so close() runs in between
+    enqueuing = threading.Event()
+    put_nowait = writer._queue.put_nowait
+
+    def slow_put_nowait(op):
+        enqueuing.set()
+        time.sleep(0.2)
+        put_nowait(op)
+
+    writer._queue.put_nowait = slow_put_nowait
+    saver = threading.Thread(target=writer.save_conversation, args=("a", "hi", "ok", "2024-01-01T00:00:00"))
+    saver.start()
+    enqueuing.wait()
+    writer.close()
+    saver.join()
+
+    with store.read("a") as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == 1
+    assert writer.stats()["queued"] == 0
+    store.close()